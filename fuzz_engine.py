@@ -0,0 +1,172 @@
+# -------------------- ДИФФЕРЕНЦИАЛЬНЫЙ ФАЗЗИНГ --------------------
+# Случайные бои с общими сидами прогоняются через эталонный движок
+# (reference_engine.py) и проверяемый (по умолчанию rpgbot). После каждого
+# хода сравниваются HP, флаги эффектов, очередность ходов и победитель.
+# Расхождение сжимается до минимального воспроизведения.
+#
+#   python fuzz_engine.py --cases 20000 --seed 1
+#   python fuzz_engine.py --replay '{"seed": ..., "fighters": [...], "actions": [...]}'
+import argparse
+import importlib
+import json
+import random
+import sys
+from dataclasses import dataclass, field, replace
+
+import reference_engine
+
+RACES = ("elf", "human", "troll")
+CLASSES = ("warrior", "paladin", "mage", "archer", "warlock")
+ACTIONS = ("attack", "block", "skill_off", "skill_def")
+STATE_FIELDS = (
+    "blocking", "shield_wall_turns", "stunned", "divine_shield_active", "holy_charged",
+    "reality_distortion_active", "dodge_boost_active", "corruption_active", "soulstone_active",
+    "skill_used", "hp_history",
+)
+
+
+@dataclass
+class Case:
+    seed: int
+    fighters: list = field(default_factory=list)  # [[раса, класс, уровень], [раса, класс, уровень]]
+    actions: list = field(default_factory=list)
+
+    def to_json(self) -> str:
+        return json.dumps({"seed": self.seed, "fighters": self.fighters, "actions": self.actions})
+
+
+def random_case(rng: random.Random, max_actions: int) -> Case:
+    return Case(
+        seed=rng.getrandbits(32),
+        fighters=[[rng.choice(RACES), rng.choice(CLASSES), rng.randint(1, 5)] for _ in range(2)],
+        actions=[rng.choice(ACTIONS) for _ in range(rng.randint(1, max_actions))],
+    )
+
+
+def _observe_character(c) -> tuple:
+    return (c.health_points,) + tuple(
+        tuple(value) if isinstance(value, list) else value
+        for value in (getattr(c.state, name) for name in STATE_FIELDS)
+    )
+
+
+def run_case(engine, case: Case) -> list[tuple]:
+    """Наблюдения после каждого хода: состояние обоих персонажей, очередь и победитель"""
+    char1, char2 = (
+        engine.Character(engine.get_race(race), engine.get_class(cls), level)
+        for race, cls, level in case.fighters
+    )
+    battle = engine.Battle(char1, char2, seed=case.seed)
+    observations = [(battle.current_player, battle.current_turn)]
+
+    for action in case.actions:
+        if battle.get_winner() is not None:
+            break
+        battle.execute_action(action)
+        observations.append((
+            battle.current_player,
+            battle.current_turn,
+            battle.get_winner(),
+            _observe_character(battle.char1),
+            _observe_character(battle.char2),
+        ))
+    return observations
+
+
+def first_difference(engine, case: Case) -> int | None:
+    """Номер первого расходящегося наблюдения или None"""
+    expected = run_case(reference_engine, case)
+    actual = run_case(engine, case)
+    for step, (a, b) in enumerate(zip(expected, actual)):
+        if a != b:
+            return step
+    if len(expected) != len(actual):
+        return min(len(expected), len(actual))
+    return None
+
+
+def shrink(engine, case: Case) -> Case:
+    """Жадное сжатие: короче список действий, проще действия, ниже уровни"""
+    step = first_difference(engine, case)
+    case = replace(case, actions=case.actions[:max(step, 1)])
+
+    def fails(candidate: Case) -> bool:
+        return first_difference(engine, candidate) is not None
+
+    improved = True
+    while improved:
+        improved = False
+
+        for i in range(len(case.actions)):
+            candidate = replace(case, actions=case.actions[:i] + case.actions[i + 1:])
+            if candidate.actions and fails(candidate):
+                case, improved = candidate, True
+                break
+        if improved:
+            continue
+
+        for i, action in enumerate(case.actions):
+            if action != "attack":
+                candidate = replace(case, actions=case.actions[:i] + ["attack"] + case.actions[i + 1:])
+                if fails(candidate):
+                    case, improved = candidate, True
+                    break
+        if improved:
+            continue
+
+        for i, (race, cls, level) in enumerate(case.fighters):
+            if level > 1:
+                fighters = [list(f) for f in case.fighters]
+                fighters[i][2] = level - 1
+                candidate = replace(case, fighters=fighters)
+                if fails(candidate):
+                    case, improved = candidate, True
+                    break
+
+    return case
+
+
+def describe(engine, case: Case) -> str:
+    expected = run_case(reference_engine, case)
+    actual = run_case(engine, case)
+    step = first_difference(engine, case)
+    lines = [f"Расхождение на наблюдении {step}:", f"  repro: {case.to_json()}"]
+    if step is not None:
+        lines.append(f"  эталон:   {expected[step] if step < len(expected) else '—'}")
+        lines.append(f"  движок:   {actual[step] if step < len(actual) else '—'}")
+    return "\n".join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Дифференциальный фаззинг движка боя против эталона")
+    parser.add_argument("--engine", default="rpgbot", help="модуль проверяемого движка")
+    parser.add_argument("--cases", type=int, default=5000)
+    parser.add_argument("--max-actions", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--replay", help="JSON случая для повторного прогона")
+    args = parser.parse_args()
+
+    engine = importlib.import_module(args.engine)
+
+    if args.replay:
+        case = Case(**json.loads(args.replay))
+        if first_difference(engine, case) is None:
+            print("Совпадает с эталоном")
+            return 0
+        print(describe(engine, case))
+        return 1
+
+    rng = random.Random(args.seed)
+    for i in range(args.cases):
+        case = random_case(rng, args.max_actions)
+        if first_difference(engine, case) is not None:
+            print(f"Случай {i}: найдено расхождение, сжатие...")
+            print(describe(engine, shrink(engine, case)))
+            return 1
+
+    print(f"Проверено случаев: {args.cases}, расхождений нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+# -------------------- НАГРУЗОЧНЫЙ ТЕСТ --------------------
+# Синтетические пользователи проходят реальные сценарии (создание персонажа,
+# профиль, бой до конца) через обработчики rpgbot. Вместо Telegram Bot API
+# используется локальная заглушка на уровне HTTP-запросов бота: она
+# записывает вызовы, добавляет задержку и иногда отвечает 429.
+#
+# Апдейты идут через app.update_queue и штатный обработчик очереди, как у
+# запущенного бота: по одному, так что задержка включает ожидание в очереди.
+#
+#   python loadtest.py --users 500 --concurrency 100 --latency-ms 30 --error-rate 0.01
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+from telegram import Bot, Update
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest
+
+import rpgbot
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "RPG Battle Bot", "username": "rpg_battle_bot"}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Заглушка Bot API: записывает вызовы, добавляет задержку и ошибки 429"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int | None = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.keyboards = {}  # chat_id -> последняя клавиатура
+        self.message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.rng.expovariate(1 / self.latency))
+
+        if endpoint != "getMe" and self.rng.random() < self.error_rate:
+            self.errors[endpoint] += 1
+            body = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1}}
+            return 429, json.dumps(body).encode()
+
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint == "answerCallbackQuery":
+            return True
+
+        chat_id = params.get("chat_id")
+        if "reply_markup" in params:
+            self.keyboards[chat_id] = params["reply_markup"]
+
+        message = {
+            "message_id": params.get("message_id") or next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if endpoint == "sendDocument":
+            message["document"] = {"file_id": "doc", "file_unique_id": "doc"}
+        return message
+
+    def buttons(self, chat_id: int) -> list[str]:
+        markup = self.keyboards.get(chat_id) or {}
+        return [button["callback_data"] for row in markup.get("inline_keyboard", []) for button in row]
+
+
+class LoadTest:
+    def __init__(self, app, api: FakeTelegramRequest, seed: int | None = None):
+        self.app = app
+        self.api = api
+        self.rng = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.latencies = []
+        self.handler_errors = 0
+        self.pending = {}  # update_id -> future, завершается после всех обработчиков
+        # Последняя группа: срабатывает, когда обработчики бота закончили с апдейтом
+        app.add_handler(TypeHandler(Update, self._done), group=1000)
+
+    async def _done(self, update: Update, context) -> None:
+        future = self.pending.pop(update.update_id, None)
+        if future is not None:
+            future.set_result(None)
+
+    def _user(self, tg_id: int) -> dict:
+        return {"id": tg_id, "is_bot": False, "first_name": f"Игрок{tg_id}", "username": f"load{tg_id}"}
+
+    async def _process(self, data: dict) -> None:
+        """Апдейт в очередь приложения и ожидание конца его обработки"""
+        update = Update.de_json(data, self.app.bot)
+        done = self.pending[update.update_id] = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        await self.app.update_queue.put(update)
+        await done
+        self.latencies.append(time.perf_counter() - started)
+
+    async def send_command(self, tg_id: int, text: str) -> None:
+        await self._process({
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.api.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": tg_id, "type": "private"},
+                "from": self._user(tg_id),
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+            },
+        })
+
+    async def press(self, tg_id: int, data: str) -> None:
+        await self._process({
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.update_ids)),
+                "from": self._user(tg_id),
+                "chat_instance": str(tg_id),
+                "data": data,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": tg_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": "...",
+                },
+            },
+        })
+
+    async def user_flow(self, tg_id: int, max_turns: int) -> None:
+        """Создание персонажа, профиль и бой с ИИ до конца"""
+        await self.send_command(tg_id, "/start")
+        await self.press(tg_id, "create_menu")
+        await self.press(tg_id, f"race_{self.rng.choice(['elf', 'human', 'troll'])}")
+        await self.press(tg_id, f"class_{self.rng.choice(['warrior', 'paladin', 'mage', 'archer', 'warlock'])}")
+        await self.press(tg_id, "me")
+        await self.press(tg_id, "fight_menu")
+
+        for _ in range(max_turns):
+            if tg_id not in rpgbot.active_battles:
+                break
+            actions = [b for b in self.api.buttons(tg_id) if b.startswith("battle_action_")]
+            if not actions:
+                # Клавиатура потерялась из-за 429 - открываем бой заново
+                await self.press(tg_id, "fight_menu")
+                continue
+            await self.press(tg_id, self.rng.choice(actions))
+
+    async def run(self, users: int, concurrency: int, max_turns: int) -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(tg_id: int) -> None:
+            async with semaphore:
+                await self.user_flow(tg_id, max_turns)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(100_000 + i) for i in range(users)))
+        return time.perf_counter() - started
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _rss_kb() -> int | None:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
+
+async def run_load_test(args) -> None:
+    workdir = tempfile.mkdtemp(prefix="rpgbot_load_")
+    rpgbot.PLAYERS_FILE = os.path.join(workdir, "players.json")
+    if args.ai_budget_ms is not None:
+        rpgbot.opponent_ai.time_budget = args.ai_budget_ms / 1000
+    if not args.throttle:
+        # Синтетические пользователи жмут кнопки быстрее человека; ограничитель мерил бы сам себя
+        rpgbot.callback_throttle = rpgbot.CallbackThrottle(rate=float("inf"), burst=1, debounce=0)
+
+    api = FakeTelegramRequest(latency=args.latency_ms / 1000, error_rate=args.error_rate, seed=args.seed)
+    bot = Bot("123456:LOADTEST", request=api, get_updates_request=FakeTelegramRequest())
+    app = rpgbot.build_application(bot=bot)
+
+    test = LoadTest(app, api, seed=args.seed)
+
+    async def count_error(update, context) -> None:
+        test.handler_errors += 1
+
+    app.add_error_handler(count_error)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = _rss_kb()
+    async with app:
+        await app.start()
+        elapsed = await test.run(args.users, args.concurrency, args.max_turns)
+        await app.stop()
+    rss_after = _rss_kb()
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    ms = [x * 1000 for x in test.latencies]
+    print("=== НАГРУЗОЧНЫЙ ТЕСТ ===")
+    print(f"Пользователей: {args.users}, параллельно: {args.concurrency}, "
+          f"бюджет ИИ: {rpgbot.opponent_ai.time_budget * 1000:.0f} мс")
+    print(f"Апдейтов: {len(ms)} за {elapsed:.2f} с ({len(ms) / elapsed:.0f} апдейтов/с)")
+    if ms:
+        print(f"Задержка ответа (очередь и обработка), мс: p50={_percentile(ms, 0.50):.2f} "
+              f"p95={_percentile(ms, 0.95):.2f} p99={_percentile(ms, 0.99):.2f} "
+              f"среднее={statistics.fmean(ms):.2f}")
+    print(f"Вызовы API: {dict(api.calls)}")
+    print(f"Ответы 429: {sum(api.errors.values())}, ошибок обработчиков: {test.handler_errors}")
+    if args.throttle:
+        print(f"Нажатий отброшено: антидребезг {rpgbot.metrics['callbacks_debounced_total']}, "
+              f"ограничение частоты {rpgbot.metrics['callbacks_throttled_total']}")
+    if args.tracemalloc:
+        print(f"Память (tracemalloc): рост {current / 1024:.0f} КБ, пик {peak / 1024:.0f} КБ")
+    if rss_before is not None:
+        print(f"Пиковый RSS: {rss_before} -> {rss_after} КБ")
+    print(f"Незавершенных боев: {len(rpgbot.active_battles)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест RPG Battle Bot с заглушкой Bot API")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--max-turns", type=int, default=60, help="предел ходов в бою на пользователя")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="средняя задержка ответа API")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--ai-budget-ms", type=float, default=None,
+                        help="бюджет ИИ на ход; по умолчанию как в боте (opponent_ai.time_budget)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--throttle", action="store_true", help="не отключать ограничение частоты нажатий")
+    parser.add_argument("--tracemalloc", action="store_true", help="точный учет памяти (замедляет тест)")
+    asyncio.run(run_load_test(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,585 @@
+# -------------------- ЭТАЛОННЫЙ ДВИЖОК --------------------
+# Замороженная копия правил боя версии 0.10 (до оптимизаций движка).
+# Эталон для fuzz_engine.py: не оптимизировать и не исправлять.
+# Единственное отличие от исходника - генератор случайных чисел боя
+# передается явно, чтобы эталон и проверяемый движок шли с одним сидом.
+import random
+from dataclasses import dataclass
+from typing import Optional
+
+
+# ==================== РАСЫ ====================
+class Race:
+    """Базовый класс расы"""
+    base_health_modifier = 1.0
+    base_attack_modifier = 1.0
+    base_defence_modifier = 1.0
+    race_name = "Раса"
+    emoji = "👤"
+
+    def on_damage_taken(self, damage: int, rng: random.Random) -> tuple[int, str | None]:
+        """Обработка получения урона (для расовых способностей)"""
+        return damage, None
+
+
+class Elf(Race):
+    race_name = "Эльф"
+    emoji = "🧝"
+    base_health_modifier = 0.9
+    base_attack_modifier = 1.1
+    dodge_chance = 0.20
+
+    def on_damage_taken(self, damage: int, rng: random.Random) -> tuple[int, str | None]:
+        if rng.random() < self.dodge_chance:
+            return 0, "Уклонение!"
+        return damage, None
+
+
+class Human(Race):
+    race_name = "Человек"
+    emoji = "⚔️"
+    base_health_modifier = 1.0
+    base_attack_modifier = 1.0
+    base_defence_modifier = 1.1
+
+
+class Troll(Race):
+    race_name = "Тролль"
+    emoji = "👹"
+    base_health_modifier = 1.3
+    base_attack_modifier = 0.9
+
+
+# ==================== КЛАССЫ ====================
+class CharacterClass:
+    """Базовый класс персонажа"""
+    base_health_points = 100
+    base_attack_power = 10
+    base_defence = 20
+    class_name = "Класс"
+    emoji = "⚔️"
+
+    crit_chance = 0.10
+    crit_multiplier = 2.0
+
+    offensive_skill_name = "Атакующий навык"
+    defensive_skill_name = "Защитный навык"
+
+
+class Warrior(CharacterClass):
+    class_name = "Воин"
+    emoji = "🛡️"
+    base_health_points = 120
+    base_attack_power = 12
+    base_defence = 30
+    crit_chance = 0.15
+    crit_multiplier = 1.8
+
+    offensive_skill_name = "Молот грома"
+    defensive_skill_name = "Поднять щиты"
+
+
+class Paladin(CharacterClass):
+    class_name = "Паладин"
+    emoji = "✨"
+    base_health_points = 110
+    base_attack_power = 11
+    base_defence = 25
+    crit_chance = 0.12
+    crit_multiplier = 2.0
+
+    offensive_skill_name = "Правосудие света"
+    defensive_skill_name = "Божественная защита"
+
+
+class Mage(CharacterClass):
+    class_name = "Маг"
+    emoji = "🔮"
+    base_health_points = 80
+    base_attack_power = 18
+    base_defence = 10
+    crit_chance = 0.25
+    crit_multiplier = 2.5
+
+    offensive_skill_name = "Искажение реальности"
+    defensive_skill_name = "Альтертайм"
+
+
+class Archer(CharacterClass):
+    class_name = "Лучник"
+    emoji = "🏹"
+    base_health_points = 90
+    base_attack_power = 14
+    base_defence = 15
+    crit_chance = 0.35
+    crit_multiplier = 2.2
+
+    offensive_skill_name = "Град стрел"
+    defensive_skill_name = "Ловкость охотника"
+
+
+class Warlock(CharacterClass):
+    class_name = "Чернокнижник"
+    emoji = "🔥"
+    base_health_points = 85
+    base_attack_power = 16
+    base_defence = 12
+    crit_chance = 0.20
+    crit_multiplier = 2.3
+
+    offensive_skill_name = "Порча"
+    defensive_skill_name = "Камень души"
+
+
+# ==================== ПЕРСОНАЖ ====================
+@dataclass
+class CharacterState:
+    """Состояние персонажа в бою"""
+    blocking: bool = False  # Защита активна
+    shield_wall_turns: int = 0  # Количество оставшихся ходов "Поднять щиты"
+    stunned: bool = False  # Оглушен
+    divine_shield_active: bool = False  # Божественная защита активна
+    holy_charged: bool = False  # Правосудие света активно
+    reality_distortion_active: bool = False  # Искажение реальности активно
+    dodge_boost_active: bool = False  # Ловкость охотника активна
+    corruption_active: bool = False  # Порча активна
+    soulstone_active: bool = False  # Камень души активен
+
+    skill_used: bool = False  # Использован ли специальный навык
+    hp_history: list = None  # История HP для Альтертайма
+
+    def __post_init__(self):
+        if self.hp_history is None:
+            self.hp_history = []
+
+
+class Character:
+    max_level = 5
+
+    def __init__(self, race: Race, char_class: CharacterClass, level: int = 1):
+        self.race = race
+        self.char_class = char_class
+        self.level = level
+
+        # Применяем расовые модификаторы
+        self.base_health_points = int(char_class.base_health_points * race.base_health_modifier)
+        self.base_attack_power = int(char_class.base_attack_power * race.base_attack_modifier)
+        self.base_defence = int(char_class.base_defence * race.base_defence_modifier)
+
+        self.health_points = self.base_health_points * level
+        self.max_hp = self.health_points
+        self.attack_power = self.base_attack_power * level
+
+        self.crit_chance = char_class.crit_chance
+        self.crit_multiplier = char_class.crit_multiplier
+
+        self.state = CharacterState()
+
+    @property
+    def character_name(self):
+        return f"{self.race.emoji} {self.char_class.emoji}"
+
+    @property
+    def full_name(self):
+        return f"{self.race.race_name} {self.char_class.class_name}"
+
+    def deal_damage(self, rng: random.Random) -> tuple[int, bool]:
+        is_crit = rng.random() < self.crit_chance
+        damage = self.attack_power * (self.crit_multiplier if is_crit else 1.0)
+        return round(damage), is_crit
+
+    @property
+    def defence(self) -> int:
+        base_def = self.base_defence * self.level
+
+        # Блок дает +50%
+        if self.state.blocking:
+            base_def = int(base_def * 1.5)
+
+        # Щиты воина дают +100%
+        if self.state.shield_wall_turns > 0:
+            base_def = int(base_def * 2)
+
+        return base_def
+
+    @property
+    def max_health_points(self) -> int:
+        return self.max_hp
+
+    def health_points_percent(self):
+        return 100 * self.health_points / self.max_health_points
+
+    def is_alive(self) -> bool:
+        return self.health_points > 0
+
+    def is_dead(self) -> bool:
+        return self.health_points <= 0
+
+    def level_up(self):
+        if self.level < self.max_level:
+            self.level += 1
+            self.health_points = self.max_health_points
+
+    def __str__(self):
+        return f"{self.full_name} (ур.{self.level}, {self.health_points}/{self.max_health_points} HP)"
+
+
+# ==================== БОЕВАЯ СИСТЕМА ====================
+class BattleAction:
+    ATTACK = "attack"
+    BLOCK = "block"
+    SKILL_OFFENSIVE = "skill_off"
+    SKILL_DEFENSIVE = "skill_def"
+
+
+class Battle:
+    def __init__(self, char1: Character, char2: Character, seed: int | None = None):
+        self.char1 = char1
+        self.char2 = char2
+        self.current_turn = 1
+        self.log = []
+        self.rng = random.Random(seed)
+
+        # Случайный выбор первого игрока
+        self.current_player = self.rng.choice([1, 2])
+
+        self.log.append(f"=== НАЧАЛО БИТВЫ ===")
+        self.log.append(f"{char1.full_name} (ур.{char1.level}) VS {char2.full_name} (ур.{char2.level})")
+        self.log.append(f"Первым ходит игрок {self.current_player}")
+        self.log.append("")
+
+    def get_current_character(self) -> Character:
+        return self.char1 if self.current_player == 1 else self.char2
+
+    def get_opponent(self) -> Character:
+        return self.char2 if self.current_player == 1 else self.char1
+
+    def switch_turn(self):
+        """Переключение хода"""
+        attacker = self.get_current_character()
+
+        # Сброс блока
+        attacker.state.blocking = False
+
+        # Уменьшение счетчиков
+        if attacker.state.shield_wall_turns > 0:
+            attacker.state.shield_wall_turns -= 1
+
+        # Сброс разовых эффектов
+        if attacker.state.holy_charged:
+            attacker.state.holy_charged = False
+
+        if attacker.state.dodge_boost_active:
+            attacker.state.dodge_boost_active = False
+
+        # Переключение игрока
+        self.current_player = 2 if self.current_player == 1 else 1
+
+        # Проверка оглушения
+        new_attacker = self.get_current_character()
+        if new_attacker.state.stunned:
+            new_attacker.state.stunned = False
+            self.log.append(f"Ход {self.current_turn}: Игрок {self.current_player} оглушен и пропускает ход")
+            self.current_turn += 1
+            self.switch_turn()
+            return
+
+        self.current_turn += 1
+
+    def execute_action(self, action: str) -> str:
+        """Выполнение действия и возврат результата"""
+        attacker = self.get_current_character()
+        defender = self.get_opponent()
+
+        # Сохранение HP в историю для Альтертайма
+        attacker.state.hp_history.append(attacker.health_points)
+        if len(attacker.state.hp_history) > 3:
+            attacker.state.hp_history.pop(0)
+
+        result = []
+        result.append(f"--- Ход {self.current_turn}: Игрок {self.current_player} ---")
+
+        if action == BattleAction.ATTACK:
+            result.extend(self._execute_attack(attacker, defender))
+        elif action == BattleAction.BLOCK:
+            result.extend(self._execute_block(attacker))
+        elif action == BattleAction.SKILL_OFFENSIVE:
+            result.extend(self._execute_offensive_skill(attacker, defender))
+        elif action == BattleAction.SKILL_DEFENSIVE:
+            result.extend(self._execute_defensive_skill(attacker, defender))
+
+        # Проверка смерти и камня души
+        if defender.is_dead() and defender.state.soulstone_active:
+            defender.health_points = int(defender.max_health_points * 0.2)
+            defender.state.soulstone_active = False
+            result.append(f"!!! КАМЕНЬ ДУШИ СРАБОТАЛ! {defender.full_name} воскрес с {defender.health_points} HP")
+
+        result.append("")
+
+        battle_log = "\n".join(result)
+        self.log.append(battle_log)
+
+        self.switch_turn()
+
+        return battle_log
+
+    def _execute_attack(self, attacker: Character, defender: Character) -> list[str]:
+        result = []
+        result.append(f"{attacker.full_name} атакует!")
+
+        raw_damage, is_crit = attacker.deal_damage(self.rng)
+
+        # Правосудие света - всегда крит, игнорирует броню
+        if attacker.state.holy_charged:
+            is_crit = True
+            final_damage = raw_damage
+            attacker.state.holy_charged = False
+            result.append(f">>> ПРАВОСУДИЕ СВЕТА! Критический урон, игнорирует броню")
+        else:
+            # Обычная атака
+            final_damage, event = self._apply_damage(defender, raw_damage)
+            if event:
+                result.append(f">>> {event}")
+
+        # Порча чернокнижника
+        if attacker.state.corruption_active:
+            corruption_dmg = int(final_damage * 0.3)
+            defender.health_points -= corruption_dmg
+            attacker.health_points = min(attacker.health_points + corruption_dmg, attacker.max_health_points)
+            result.append(
+                f">>> ПОРЧА: +{corruption_dmg} урона (игнорирует броню), чернокнижник излечен на {corruption_dmg} HP")
+
+        crit_text = " [КРИТИЧЕСКИЙ УДАР!]" if is_crit else ""
+        result.append(f"Урон: {raw_damage}{crit_text} -> {final_damage} (после защиты)")
+        result.append(f"{defender.full_name}: {defender.health_points}/{defender.max_health_points} HP")
+
+        return result
+
+    def _execute_block(self, attacker: Character) -> list[str]:
+        attacker.state.blocking = True
+        return [
+            f"{attacker.full_name} встает в блок!",
+            f"Защита повышена на 50% до следующего хода"
+        ]
+
+    def _execute_offensive_skill(self, attacker: Character, defender: Character) -> list[str]:
+        if attacker.state.skill_used:
+            return ["Специальный навык уже использован!"]
+
+        attacker.state.skill_used = True
+        result = []
+
+        if isinstance(attacker.char_class, Paladin):
+            # Правосудие света
+            attacker.state.holy_charged = True
+            result.append(f">>> {attacker.full_name} использует ПРАВОСУДИЕ СВЕТА!")
+            result.append(f"Следующая атака будет критической и проигнорирует броню")
+
+        elif isinstance(attacker.char_class, Mage):
+            # Искажение реальности
+            attacker.state.reality_distortion_active = True
+            result.append(f">>> {attacker.full_name} использует ИСКАЖЕНИЕ РЕАЛЬНОСТИ!")
+            result.append(f"Весь входящий урон увеличен на 35%")
+            result.append(f"При использовании противником навыка - взрыв!")
+
+        elif isinstance(attacker.char_class, Warrior):
+            # Молот грома
+            raw_damage = int(attacker.attack_power * 0.5)
+            final_damage, _ = self._apply_damage(defender, raw_damage)
+            defender.state.stunned = True
+            result.append(f">>> {attacker.full_name} использует МОЛОТ ГРОМА!")
+            result.append(f"Урон: {final_damage}")
+            result.append(f"Противник оглушен на 1 ход!")
+            result.append(f"{defender.full_name}: {defender.health_points}/{defender.max_health_points} HP")
+
+        elif isinstance(attacker.char_class, Archer):
+            # Град стрел - 3 атаки по 70%
+            result.append(f">>> {attacker.full_name} использует ГРАД СТРЕЛ!")
+            total_damage = 0
+            for i in range(3):
+                raw_damage, is_crit = attacker.deal_damage(self.rng)
+                raw_damage = int(raw_damage * 0.7)
+                final_damage, event = self._apply_damage(defender, raw_damage)
+                total_damage += final_damage
+                crit_text = " [КРИТ!]" if is_crit else ""
+                result.append(f"Стрела {i + 1}: {final_damage} урона{crit_text}")
+                if defender.is_dead() and not defender.state.soulstone_active:
+                    break
+            result.append(f"Общий урон: {total_damage}")
+            result.append(f"{defender.full_name}: {defender.health_points}/{defender.max_health_points} HP")
+
+        elif isinstance(attacker.char_class, Warlock):
+            # Порча
+            attacker.state.corruption_active = True
+            result.append(f">>> {attacker.full_name} использует ПОРЧУ!")
+            result.append(f"Все атаки теперь накладывают порчу: +30% урона, игнорирует броню")
+            result.append(f"Чернокнижник лечится на размер дополнительного урона")
+
+        return result
+
+    def _execute_defensive_skill(self, attacker: Character, defender: Character) -> list[str]:
+        if attacker.state.skill_used:
+            return ["Специальный навык уже использован!"]
+
+        attacker.state.skill_used = True
+        result = []
+
+        if isinstance(attacker.char_class, Paladin):
+            # Божественная защита
+            attacker.state.divine_shield_active = True
+            result.append(f">>> {attacker.full_name} использует БОЖЕСТВЕННУЮ ЗАЩИТУ!")
+            result.append(f"Следующий входящий урон излечит паладина")
+
+        elif isinstance(attacker.char_class, Mage):
+            # Альтертайм
+            if len(attacker.state.hp_history) >= 2:
+                old_hp = attacker.state.hp_history[-2]
+                healed = old_hp - attacker.health_points
+                attacker.health_points = min(old_hp, attacker.max_health_points)
+                result.append(f">>> {attacker.full_name} использует АЛЬТЕРТАЙМ!")
+                result.append(f"HP восстановлено до {attacker.health_points} (+{healed} HP)")
+            else:
+                result.append(f">>> {attacker.full_name} использует АЛЬТЕРТАЙМ!")
+                result.append(f"Недостаточно истории для отката")
+
+        elif isinstance(attacker.char_class, Warrior):
+            # Поднять щиты
+            attacker.state.shield_wall_turns = 2
+            result.append(f">>> {attacker.full_name} использует ПОДНЯТЬ ЩИТЫ!")
+            result.append(f"Весь входящий урон уменьшен на 60% на следующие 2 хода")
+
+        elif isinstance(attacker.char_class, Archer):
+            # Ловкость охотника
+            attacker.state.dodge_boost_active = True
+            result.append(f">>> {attacker.full_name} использует ЛОВКОСТЬ ОХОТНИКА!")
+            result.append(f"Шанс уклонения повышен на 80% на следующий ход")
+
+        elif isinstance(attacker.char_class, Warlock):
+            # Камень души
+            attacker.state.soulstone_active = True
+            result.append(f">>> {attacker.full_name} использует КАМЕНЬ ДУШИ!")
+            result.append(f"При получении смертельного урона - воскрешение с 20% HP")
+
+        return result
+
+    def _apply_damage(self, defender: Character, raw_damage: int) -> tuple[int, Optional[str]]:
+        """Применение урона с учетом всех эффектов"""
+        event = None
+
+        # Искажение реальности - увеличение урона на 35%
+        if defender.state.reality_distortion_active:
+            raw_damage = int(raw_damage * 1.35)
+            event = "Искажение реальности: урон увеличен на 35%"
+
+        # Божественная защита - превращает урон в лечение
+        if defender.state.divine_shield_active:
+            defender.health_points = min(defender.health_points + raw_damage, defender.max_health_points)
+            defender.state.divine_shield_active = False
+            return 0, f"БОЖЕСТВЕННАЯ ЗАЩИТА! Урон превращен в {raw_damage} HP лечения"
+
+        # Ловкость охотника - 80% шанс уклонения
+        if defender.state.dodge_boost_active and self.rng.random() < 0.8:
+            return 0, "ЛОВКОСТЬ ОХОТНИКА! Уклонение!"
+
+        # Расовое уклонение эльфа
+        racial_damage, racial_event = defender.race.on_damage_taken(raw_damage, self.rng)
+        if racial_event:
+            return 0, racial_event
+
+        # Применение защиты
+        final_damage = racial_damage * (100 - defender.defence) / 100
+        final_damage = max(1, round(final_damage))  # Минимум 1 урон
+
+        defender.health_points -= final_damage
+
+        return final_damage, event
+
+    def get_battle_status(self) -> str:
+        """Текущее состояние боя"""
+        lines = []
+        lines.append("=== СОСТОЯНИЕ БОЯ ===")
+        lines.append(f"Ход: {self.current_turn}")
+        lines.append("")
+
+        for i, char in enumerate([self.char1, self.char2], 1):
+            lines.append(f"Игрок {i}: {char.full_name}")
+            lines.append(f"HP: {char.health_points}/{char.max_health_points}")
+            lines.append(f"Защита: {char.defence}")
+
+            effects = []
+            if char.state.blocking:
+                effects.append("Блок активен")
+            if char.state.shield_wall_turns > 0:
+                effects.append(f"Щиты ({char.state.shield_wall_turns} хода)")
+            if char.state.divine_shield_active:
+                effects.append("Божественная защита")
+            if char.state.holy_charged:
+                effects.append("Правосудие света готово")
+            if char.state.reality_distortion_active:
+                effects.append("Искажение реальности")
+            if char.state.dodge_boost_active:
+                effects.append("Ловкость охотника")
+            if char.state.corruption_active:
+                effects.append("Порча активна")
+            if char.state.soulstone_active:
+                effects.append("Камень души готов")
+            if char.state.stunned:
+                effects.append("Оглушен")
+
+            if effects:
+                lines.append(f"Эффекты: {', '.join(effects)}")
+
+            if char.state.skill_used:
+                lines.append(f"Навык использован: ДА")
+            else:
+                lines.append(f"Навык доступен: ДА")
+
+            lines.append("")
+
+        return "\n".join(lines)
+
+    def get_winner(self) -> Optional[int]:
+        """Возвращает номер победителя или None"""
+        if self.char1.is_dead():
+            return 2
+        elif self.char2.is_dead():
+            return 1
+        return None
+
+    def get_full_log(self) -> str:
+        """Полный лог боя"""
+        result = "\n".join(self.log)
+
+        winner = self.get_winner()
+        if winner:
+            result += f"\n\n=== ПОБЕДИТЕЛЬ: Игрок {winner} ==="
+            winner_char = self.char1 if winner == 1 else self.char2
+            result += f"\n{winner_char.full_name} побеждает!"
+
+        return result
+
+
+def get_race(race_name: str) -> Race:
+    race_name = race_name.lower()
+    if race_name == "elf":
+        return Elf()
+    elif race_name == "human":
+        return Human()
+    elif race_name == "troll":
+        return Troll()
+    raise ValueError("Unknown race")
+
+
+def get_class(class_name: str) -> CharacterClass:
+    class_name = class_name.lower()
+    if class_name == "warrior":
+        return Warrior()
+    elif class_name == "paladin":
+        return Paladin()
+    elif class_name == "mage":
+        return Mage()
+    elif class_name == "archer":
+        return Archer()
+    elif class_name == "warlock":
+        return Warlock()
+    raise ValueError("Unknown class")
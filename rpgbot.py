@@ -1,17 +1,52 @@
 # -------------------- GAME ENGINE --------------------
+import argparse
+import asyncio
+import collections
+import contextlib
+import copy
+import csv
 import datetime
+import functools
+import gzip
+import heapq
+import itertools
 import json
+import mmap
+import multiprocessing
 import os
 import random
+import secrets
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import zlib
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
-from dataclasses import dataclass, asdict
-from typing import Optional
+from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, TypeHandler
+import dataclasses
+from dataclasses import dataclass, asdict, field, fields
+from typing import Callable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка недоступна
+    fcntl = None
 
 current_datetime = datetime.datetime.now()
 version = 0.10
 
 
+def roll_chance(chance: float) -> bool:
+    """Бросок с вероятностью chance на общем генераторе"""
+    return random.random() < chance
+
+
 # ==================== РАСЫ ====================
 class Race:
     """Базовый класс расы"""
@@ -21,7 +56,7 @@ class Race:
     race_name = "Раса"
     emoji = "👤"
 
-    def on_damage_taken(self, damage: int) -> tuple[int, str | None]:
+    def on_damage_taken(self, damage: int, roll=None) -> tuple[int, str | None]:
         """Обработка получения урона (для расовых способностей)"""
         return damage, None
 
@@ -33,8 +68,8 @@ class Elf(Race):
     base_attack_modifier = 1.1
     dodge_chance = 0.20
 
-    def on_damage_taken(self, damage: int) -> tuple[int, str | None]:
-        if random.random() < self.dodge_chance:
+    def on_damage_taken(self, damage: int, roll=None) -> tuple[int, str | None]:
+        if (roll or roll_chance)(self.dodge_chance):
             return 0, "Уклонение!"
         return damage, None
 
@@ -69,6 +104,15 @@ class CharacterClass:
     offensive_skill_name = "Атакующий навык"
     defensive_skill_name = "Защитный навык"
 
+    # Реализации навыков подставляет register_skill
+    @staticmethod
+    def offensive_skill(battle, attacker, defender) -> list[str]:
+        return []
+
+    @staticmethod
+    def defensive_skill(battle, attacker, defender) -> list[str]:
+        return []
+
 
 class Warrior(CharacterClass):
     class_name = "Воин"
@@ -156,6 +200,25 @@ class CharacterState:
         if self.hp_history is None:
             self.hp_history = []
 
+    def as_tuple(self) -> tuple:
+        """Компактный снимок состояния (только числа и флаги)"""
+        return (
+            self.blocking, self.shield_wall_turns, self.stunned,
+            self.divine_shield_active, self.holy_charged, self.reality_distortion_active,
+            self.dodge_boost_active, self.corruption_active, self.soulstone_active,
+            self.skill_used, tuple(self.hp_history),
+        )
+
+    def load_tuple(self, values: tuple) -> None:
+        """Восстановление состояния из снимка as_tuple()"""
+        (
+            self.blocking, self.shield_wall_turns, self.stunned,
+            self.divine_shield_active, self.holy_charged, self.reality_distortion_active,
+            self.dodge_boost_active, self.corruption_active, self.soulstone_active,
+            self.skill_used, history,
+        ) = values
+        self.hp_history = list(history)
+
 
 class Character:
     max_level = 5
@@ -178,6 +241,25 @@ class Character:
         self.crit_multiplier = char_class.crit_multiplier
 
         self.state = CharacterState()
+        self.refresh_effects()
+
+    def refresh_effects(self) -> None:
+        """Пересборка списков обработчиков по активным эффектам"""
+        key = tuple(bool(getattr(self.state, effect.name)) for effect in EFFECTS)
+        compiled = _compiled_effects.get(key)
+        if compiled is None:
+            active = tuple(effect for effect, on in zip(EFFECTS, key) if on)
+            hooks = {
+                hook: tuple(getattr(effect, hook) for effect in active if getattr(effect, hook))
+                for hook in HOOKS
+            }
+            compiled = _compiled_effects[key] = (active, hooks)
+        self.effects, self.hooks = compiled
+
+    def set_effect(self, name: str, value) -> None:
+        """Изменение флага эффекта. Прямая запись в state не обновит хуки"""
+        setattr(self.state, name, value)
+        self.refresh_effects()
 
     @property
     def character_name(self):
@@ -187,8 +269,8 @@ class Character:
     def full_name(self):
         return f"{self.race.race_name} {self.char_class.class_name}"
 
-    def deal_damage(self) -> tuple[int, bool]:
-        is_crit = random.random() < self.crit_chance
+    def deal_damage(self, roll=None) -> tuple[int, bool]:
+        is_crit = (roll or roll_chance)(self.crit_chance)
         damage = self.attack_power * (self.crit_multiplier if is_crit else 1.0)
         return round(damage), is_crit
 
@@ -224,10 +306,146 @@ class Character:
             self.level += 1
             self.health_points = self.max_health_points
 
+    def snapshot(self) -> tuple:
+        """Изменяемая часть персонажа в бою: HP и эффекты"""
+        return self.health_points, self.state.as_tuple()
+
+    def restore(self, snap: tuple) -> None:
+        self.health_points, state = snap
+        self.state.load_tuple(state)
+        self.refresh_effects()
+
+    def clone(self) -> "Character":
+        """Копия персонажа; раса и класс не имеют состояния и переиспользуются"""
+        twin = copy.copy(self)
+        twin.state = CharacterState()
+        twin.state.load_tuple(self.state.as_tuple())
+        return twin
+
     def __str__(self):
         return f"{self.full_name} (ур.{self.level}, {self.health_points}/{self.max_health_points} HP)"
 
 
+# ==================== ЭФФЕКТЫ ====================
+HOOKS = ("on_attack", "on_hit", "on_damage_taken", "on_turn_end", "on_death")
+
+
+@dataclass
+class Hit:
+    """Параметры одного удара, которые меняют обработчики эффектов"""
+    raw_damage: int
+    is_crit: bool = False
+    final_damage: int = 0
+    event: str | None = None
+    resolved: bool = False  # Удар обработан эффектом, защита не применяется
+
+
+@dataclass(frozen=True)
+class Effect:
+    """Эффект: флаг в CharacterState, подпись в статусе и обработчики хуков.
+
+    on_attack(battle, attacker, defender, hit, result) - до нанесения урона атакой
+    on_hit(battle, attacker, defender, hit, result) - после нанесения урона атакой
+    on_damage_taken(battle, defender, hit) - при получении урона
+    on_turn_end(battle, character) - в конце хода персонажа
+    on_death(battle, character, result) - при смертельном уроне
+    """
+    name: str
+    label: str
+    on_attack: Optional[Callable] = None
+    on_hit: Optional[Callable] = None
+    on_damage_taken: Optional[Callable] = None
+    on_turn_end: Optional[Callable] = None
+    on_death: Optional[Callable] = None
+
+
+# Порядок регистрации задает порядок срабатывания и вывода в статусе
+EFFECTS: list[Effect] = []
+_compiled_effects = {}
+
+
+def register_effect(effect: Effect) -> Effect:
+    EFFECTS.append(effect)
+    _compiled_effects.clear()
+    return effect
+
+
+def _expire_on_turn_end(name: str) -> Callable:
+    def handler(battle, character):
+        character.set_effect(name, False)
+
+    return handler
+
+
+def _shield_wall_turn_end(battle, character):
+    character.set_effect("shield_wall_turns", character.state.shield_wall_turns - 1)
+
+
+def _holy_on_attack(battle, attacker, defender, hit, result):
+    # Правосудие света - всегда крит, игнорирует броню
+    hit.is_crit = True
+    hit.final_damage = hit.raw_damage
+    hit.resolved = True
+    attacker.set_effect("holy_charged", False)
+    result.append(f">>> ПРАВОСУДИЕ СВЕТА! Критический урон, игнорирует броню")
+
+
+def _distortion_damage_taken(battle, defender, hit):
+    # Искажение реальности - увеличение урона на 35%
+    hit.raw_damage = int(hit.raw_damage * 1.35)
+    hit.event = "Искажение реальности: урон увеличен на 35%"
+
+
+def _divine_shield_damage_taken(battle, defender, hit):
+    # Божественная защита - превращает урон в лечение
+    defender.health_points = min(defender.health_points + hit.raw_damage, defender.max_health_points)
+    defender.set_effect("divine_shield_active", False)
+    hit.final_damage = 0
+    hit.event = f"БОЖЕСТВЕННАЯ ЗАЩИТА! Урон превращен в {hit.raw_damage} HP лечения"
+    hit.resolved = True
+
+
+def _dodge_boost_damage_taken(battle, defender, hit):
+    # Ловкость охотника - 80% шанс уклонения
+    if battle.roll(0.8):
+        hit.final_damage = 0
+        hit.event = "ЛОВКОСТЬ ОХОТНИКА! Уклонение!"
+        hit.resolved = True
+
+
+def _corruption_on_hit(battle, attacker, defender, hit, result):
+    # Порча чернокнижника
+    corruption_dmg = int(hit.final_damage * 0.3)
+    defender.health_points -= corruption_dmg
+    attacker.health_points = min(attacker.health_points + corruption_dmg, attacker.max_health_points)
+    result.append(
+        f">>> ПОРЧА: +{corruption_dmg} урона (игнорирует броню), чернокнижник излечен на {corruption_dmg} HP")
+
+
+def _soulstone_on_death(battle, character, result):
+    character.health_points = int(character.max_health_points * 0.2)
+    character.set_effect("soulstone_active", False)
+    result.append(f"!!! КАМЕНЬ ДУШИ СРАБОТАЛ! {character.full_name} воскрес с {character.health_points} HP")
+
+
+register_effect(Effect("blocking", "Блок активен", on_turn_end=_expire_on_turn_end("blocking")))
+register_effect(Effect(
+    "shield_wall_turns", "Щиты ({state.shield_wall_turns} хода)", on_turn_end=_shield_wall_turn_end))
+register_effect(Effect(
+    "divine_shield_active", "Божественная защита", on_damage_taken=_divine_shield_damage_taken))
+register_effect(Effect(
+    "holy_charged", "Правосудие света готово",
+    on_attack=_holy_on_attack, on_turn_end=_expire_on_turn_end("holy_charged")))
+register_effect(Effect(
+    "reality_distortion_active", "Искажение реальности", on_damage_taken=_distortion_damage_taken))
+register_effect(Effect(
+    "dodge_boost_active", "Ловкость охотника",
+    on_damage_taken=_dodge_boost_damage_taken, on_turn_end=_expire_on_turn_end("dodge_boost_active")))
+register_effect(Effect("corruption_active", "Порча активна", on_hit=_corruption_on_hit))
+register_effect(Effect("soulstone_active", "Камень души готов", on_death=_soulstone_on_death))
+register_effect(Effect("stunned", "Оглушен"))
+
+
 # ==================== БОЕВАЯ СИСТЕМА ====================
 class BattleAction:
     ATTACK = "attack"
@@ -237,20 +455,66 @@ class BattleAction:
 
 
 class Battle:
-    def __init__(self, char1: Character, char2: Character):
+    def __init__(self, char1: Character, char2: Character, seed: int | None = None):
         self.char1 = char1
         self.char2 = char2
         self.current_turn = 1
         self.log = []
 
+        # Короткий идентификатор для кнопок и поиска боя
+        self.battle_id = secrets.token_hex(4)
+
+        # Собственный генератор боя, чтобы его состояние входило в снимок
+        self.rng = random.Random(seed)
+
         # Случайный выбор первого игрока
-        self.current_player = random.choice([1, 2])
+        self.current_player = self.rng.choice([1, 2])
 
         self.log.append(f"=== НАЧАЛО БИТВЫ ===")
         self.log.append(f"{char1.full_name} (ур.{char1.level}) VS {char2.full_name} (ур.{char2.level})")
         self.log.append(f"Первым ходит игрок {self.current_player}")
         self.log.append("")
 
+    def roll(self, chance: float) -> bool:
+        """Бросок с вероятностью chance на генераторе боя"""
+        return self.rng.random() < chance
+
+    def snapshot(self, with_rng: bool = True) -> tuple:
+        """Снимок изменяемого состояния боя.
+
+        Лог только дописывается, поэтому в снимок попадает лишь его длина.
+        """
+        return (
+            self.current_player,
+            self.current_turn,
+            len(self.log),
+            self.char1.snapshot(),
+            self.char2.snapshot(),
+            self.rng.getstate() if with_rng else None,
+        )
+
+    def restore(self, snap: tuple) -> None:
+        """Откат боя к снимку snapshot()"""
+        self.current_player, self.current_turn, log_len, snap1, snap2, rng_state = snap
+        del self.log[log_len:]
+        self.char1.restore(snap1)
+        self.char2.restore(snap2)
+        if rng_state is not None:
+            self.rng.setstate(rng_state)
+
+    def clone(self) -> "Battle":
+        """Независимая копия боя без deepcopy"""
+        twin = Battle.__new__(Battle)
+        twin.battle_id = self.battle_id
+        twin.char1 = self.char1.clone()
+        twin.char2 = self.char2.clone()
+        twin.current_turn = self.current_turn
+        twin.current_player = self.current_player
+        twin.log = list(self.log)
+        twin.rng = random.Random()
+        twin.rng.setstate(self.rng.getstate())
+        return twin
+
     def get_current_character(self) -> Character:
         return self.char1 if self.current_player == 1 else self.char2
 
@@ -261,19 +525,9 @@ class Battle:
         """Переключение хода"""
         attacker = self.get_current_character()
 
-        # Сброс блока
-        attacker.state.blocking = False
-
-        # Уменьшение счетчиков
-        if attacker.state.shield_wall_turns > 0:
-            attacker.state.shield_wall_turns -= 1
-
-        # Сброс разовых эффектов
-        if attacker.state.holy_charged:
-            attacker.state.holy_charged = False
-
-        if attacker.state.dodge_boost_active:
-            attacker.state.dodge_boost_active = False
+        # Сброс блока, уменьшение счетчиков, сброс разовых эффектов
+        for handler in attacker.hooks["on_turn_end"]:
+            handler(self, attacker)
 
         # Переключение игрока
         self.current_player = 2 if self.current_player == 1 else 1
@@ -281,7 +535,7 @@ class Battle:
         # Проверка оглушения
         new_attacker = self.get_current_character()
         if new_attacker.state.stunned:
-            new_attacker.state.stunned = False
+            new_attacker.set_effect("stunned", False)
             self.log.append(f"Ход {self.current_turn}: Игрок {self.current_player} оглушен и пропускает ход")
             self.current_turn += 1
             self.switch_turn()
@@ -306,16 +560,13 @@ class Battle:
             result.extend(self._execute_attack(attacker, defender))
         elif action == BattleAction.BLOCK:
             result.extend(self._execute_block(attacker))
-        elif action == BattleAction.SKILL_OFFENSIVE:
-            result.extend(self._execute_offensive_skill(attacker, defender))
-        elif action == BattleAction.SKILL_DEFENSIVE:
-            result.extend(self._execute_defensive_skill(attacker, defender))
+        elif action in SKILL_SLOTS:
+            result.extend(self._execute_skill(attacker, defender, action))
 
         # Проверка смерти и камня души
-        if defender.is_dead() and defender.state.soulstone_active:
-            defender.health_points = int(defender.max_health_points * 0.2)
-            defender.state.soulstone_active = False
-            result.append(f"!!! КАМЕНЬ ДУШИ СРАБОТАЛ! {defender.full_name} воскрес с {defender.health_points} HP")
+        if defender.is_dead():
+            for handler in defender.hooks["on_death"]:
+                handler(self, defender, result)
 
         result.append("")
 
@@ -330,162 +581,53 @@ class Battle:
         result = []
         result.append(f"{attacker.full_name} атакует!")
 
-        raw_damage, is_crit = attacker.deal_damage()
+        raw_damage, is_crit = attacker.deal_damage(self.roll)
+        hit = Hit(raw_damage, is_crit)
 
-        # Правосудие света - всегда крит, игнорирует броню
-        if attacker.state.holy_charged:
-            is_crit = True
-            final_damage = raw_damage
-            attacker.state.holy_charged = False
-            result.append(f">>> ПРАВОСУДИЕ СВЕТА! Критический урон, игнорирует броню")
-        else:
+        for handler in attacker.hooks["on_attack"]:
+            handler(self, attacker, defender, hit, result)
+
+        if not hit.resolved:
             # Обычная атака
-            final_damage, event = self._apply_damage(defender, raw_damage)
+            hit.final_damage, event = self._apply_damage(defender, raw_damage)
             if event:
                 result.append(f">>> {event}")
 
-        # Порча чернокнижника
-        if attacker.state.corruption_active:
-            corruption_dmg = int(final_damage * 0.3)
-            defender.health_points -= corruption_dmg
-            attacker.health_points = min(attacker.health_points + corruption_dmg, attacker.max_health_points)
-            result.append(
-                f">>> ПОРЧА: +{corruption_dmg} урона (игнорирует броню), чернокнижник излечен на {corruption_dmg} HP")
+        for handler in attacker.hooks["on_hit"]:
+            handler(self, attacker, defender, hit, result)
 
-        crit_text = " [КРИТИЧЕСКИЙ УДАР!]" if is_crit else ""
-        result.append(f"Урон: {raw_damage}{crit_text} -> {final_damage} (после защиты)")
+        crit_text = " [КРИТИЧЕСКИЙ УДАР!]" if hit.is_crit else ""
+        result.append(f"Урон: {raw_damage}{crit_text} -> {hit.final_damage} (после защиты)")
         result.append(f"{defender.full_name}: {defender.health_points}/{defender.max_health_points} HP")
 
         return result
 
     def _execute_block(self, attacker: Character) -> list[str]:
-        attacker.state.blocking = True
+        attacker.set_effect("blocking", True)
         return [
             f"{attacker.full_name} встает в блок!",
             f"Защита повышена на 50% до следующего хода"
         ]
 
-    def _execute_offensive_skill(self, attacker: Character, defender: Character) -> list[str]:
-        if attacker.state.skill_used:
-            return ["Специальный навык уже использован!"]
-
-        attacker.state.skill_used = True
-        result = []
-
-        if isinstance(attacker.char_class, Paladin):
-            # Правосудие света
-            attacker.state.holy_charged = True
-            result.append(f">>> {attacker.full_name} использует ПРАВОСУДИЕ СВЕТА!")
-            result.append(f"Следующая атака будет критической и проигнорирует броню")
-
-        elif isinstance(attacker.char_class, Mage):
-            # Искажение реальности
-            attacker.state.reality_distortion_active = True
-            result.append(f">>> {attacker.full_name} использует ИСКАЖЕНИЕ РЕАЛЬНОСТИ!")
-            result.append(f"Весь входящий урон увеличен на 35%")
-            result.append(f"При использовании противником навыка - взрыв!")
-
-        elif isinstance(attacker.char_class, Warrior):
-            # Молот грома
-            raw_damage = int(attacker.attack_power * 0.5)
-            final_damage, _ = self._apply_damage(defender, raw_damage)
-            defender.state.stunned = True
-            result.append(f">>> {attacker.full_name} использует МОЛОТ ГРОМА!")
-            result.append(f"Урон: {final_damage}")
-            result.append(f"Противник оглушен на 1 ход!")
-            result.append(f"{defender.full_name}: {defender.health_points}/{defender.max_health_points} HP")
-
-        elif isinstance(attacker.char_class, Archer):
-            # Град стрел - 3 атаки по 70%
-            result.append(f">>> {attacker.full_name} использует ГРАД СТРЕЛ!")
-            total_damage = 0
-            for i in range(3):
-                raw_damage, is_crit = attacker.deal_damage()
-                raw_damage = int(raw_damage * 0.7)
-                final_damage, event = self._apply_damage(defender, raw_damage)
-                total_damage += final_damage
-                crit_text = " [КРИТ!]" if is_crit else ""
-                result.append(f"Стрела {i + 1}: {final_damage} урона{crit_text}")
-                if defender.is_dead() and not defender.state.soulstone_active:
-                    break
-            result.append(f"Общий урон: {total_damage}")
-            result.append(f"{defender.full_name}: {defender.health_points}/{defender.max_health_points} HP")
-
-        elif isinstance(attacker.char_class, Warlock):
-            # Порча
-            attacker.state.corruption_active = True
-            result.append(f">>> {attacker.full_name} использует ПОРЧУ!")
-            result.append(f"Все атаки теперь накладывают порчу: +30% урона, игнорирует броню")
-            result.append(f"Чернокнижник лечится на размер дополнительного урона")
-
-        return result
-
-    def _execute_defensive_skill(self, attacker: Character, defender: Character) -> list[str]:
+    def _execute_skill(self, attacker: Character, defender: Character, action: str) -> list[str]:
         if attacker.state.skill_used:
             return ["Специальный навык уже использован!"]
 
         attacker.state.skill_used = True
-        result = []
-
-        if isinstance(attacker.char_class, Paladin):
-            # Божественная защита
-            attacker.state.divine_shield_active = True
-            result.append(f">>> {attacker.full_name} использует БОЖЕСТВЕННУЮ ЗАЩИТУ!")
-            result.append(f"Следующий входящий урон излечит паладина")
-
-        elif isinstance(attacker.char_class, Mage):
-            # Альтертайм
-            if len(attacker.state.hp_history) >= 2:
-                old_hp = attacker.state.hp_history[-2]
-                healed = old_hp - attacker.health_points
-                attacker.health_points = min(old_hp, attacker.max_health_points)
-                result.append(f">>> {attacker.full_name} использует АЛЬТЕРТАЙМ!")
-                result.append(f"HP восстановлено до {attacker.health_points} (+{healed} HP)")
-            else:
-                result.append(f">>> {attacker.full_name} использует АЛЬТЕРТАЙМ!")
-                result.append(f"Недостаточно истории для отката")
-
-        elif isinstance(attacker.char_class, Warrior):
-            # Поднять щиты
-            attacker.state.shield_wall_turns = 2
-            result.append(f">>> {attacker.full_name} использует ПОДНЯТЬ ЩИТЫ!")
-            result.append(f"Весь входящий урон уменьшен на 60% на следующие 2 хода")
-
-        elif isinstance(attacker.char_class, Archer):
-            # Ловкость охотника
-            attacker.state.dodge_boost_active = True
-            result.append(f">>> {attacker.full_name} использует ЛОВКОСТЬ ОХОТНИКА!")
-            result.append(f"Шанс уклонения повышен на 80% на следующий ход")
-
-        elif isinstance(attacker.char_class, Warlock):
-            # Камень души
-            attacker.state.soulstone_active = True
-            result.append(f">>> {attacker.full_name} использует КАМЕНЬ ДУШИ!")
-            result.append(f"При получении смертельного урона - воскрешение с 20% HP")
-
-        return result
+        skill = getattr(attacker.char_class, SKILL_SLOTS[action])
+        return skill(self, attacker, defender)
 
     def _apply_damage(self, defender: Character, raw_damage: int) -> tuple[int, Optional[str]]:
         """Применение урона с учетом всех эффектов"""
-        event = None
-
-        # Искажение реальности - увеличение урона на 35%
-        if defender.state.reality_distortion_active:
-            raw_damage = int(raw_damage * 1.35)
-            event = "Искажение реальности: урон увеличен на 35%"
-
-        # Божественная защита - превращает урон в лечение
-        if defender.state.divine_shield_active:
-            defender.health_points = min(defender.health_points + raw_damage, defender.max_health_points)
-            defender.state.divine_shield_active = False
-            return 0, f"БОЖЕСТВЕННАЯ ЗАЩИТА! Урон превращен в {raw_damage} HP лечения"
+        hit = Hit(raw_damage)
 
-        # Ловкость охотника - 80% шанс уклонения
-        if defender.state.dodge_boost_active and random.random() < 0.8:
-            return 0, "ЛОВКОСТЬ ОХОТНИКА! Уклонение!"
+        for handler in defender.hooks["on_damage_taken"]:
+            handler(self, defender, hit)
+            if hit.resolved:
+                return hit.final_damage, hit.event
 
         # Расовое уклонение эльфа
-        racial_damage, racial_event = defender.race.on_damage_taken(raw_damage)
+        racial_damage, racial_event = defender.race.on_damage_taken(hit.raw_damage, self.roll)
         if racial_event:
             return 0, racial_event
 
@@ -495,7 +637,7 @@ class Battle:
 
         defender.health_points -= final_damage
 
-        return final_damage, event
+        return final_damage, hit.event
 
     def get_battle_status(self) -> str:
         """Текущее состояние боя"""
@@ -504,30 +646,13 @@ class Battle:
         lines.append(f"Ход: {self.current_turn}")
         lines.append("")
 
-        for i, char in enumerate([self.char1, self.char2], 1):
+        for i, (char, other) in enumerate([(self.char1, self.char2), (self.char2, self.char1)], 1):
             lines.append(f"Игрок {i}: {char.full_name}")
             lines.append(f"HP: {char.health_points}/{char.max_health_points}")
             lines.append(f"Защита: {char.defence}")
+            lines.append(f"Ожидаемый урон атаки: {expected_damage(char, other):.1f}")
 
-            effects = []
-            if char.state.blocking:
-                effects.append("Блок активен")
-            if char.state.shield_wall_turns > 0:
-                effects.append(f"Щиты ({char.state.shield_wall_turns} хода)")
-            if char.state.divine_shield_active:
-                effects.append("Божественная защита")
-            if char.state.holy_charged:
-                effects.append("Правосудие света готово")
-            if char.state.reality_distortion_active:
-                effects.append("Искажение реальности")
-            if char.state.dodge_boost_active:
-                effects.append("Ловкость охотника")
-            if char.state.corruption_active:
-                effects.append("Порча активна")
-            if char.state.soulstone_active:
-                effects.append("Камень души готов")
-            if char.state.stunned:
-                effects.append("Оглушен")
+            effects = [effect.label.format(state=char.state) for effect in char.effects]
 
             if effects:
                 lines.append(f"Эффекты: {', '.join(effects)}")
@@ -562,10 +687,448 @@ class Battle:
         return result
 
 
+# ==================== НАВЫКИ ====================
+SKILL_SLOTS = {
+    BattleAction.SKILL_OFFENSIVE: "offensive_skill",
+    BattleAction.SKILL_DEFENSIVE: "defensive_skill",
+}
+
+
+def register_skill(char_class: type, action: str) -> Callable:
+    """Декоратор: навык класса char_class для действия action"""
+
+    def decorator(func):
+        setattr(char_class, SKILL_SLOTS[action], staticmethod(func))
+        return func
+
+    return decorator
+
+
+@register_skill(Paladin, BattleAction.SKILL_OFFENSIVE)
+def _holy_justice(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Правосудие света
+    attacker.set_effect("holy_charged", True)
+    return [
+        f">>> {attacker.full_name} использует ПРАВОСУДИЕ СВЕТА!",
+        f"Следующая атака будет критической и проигнорирует броню",
+    ]
+
+
+@register_skill(Mage, BattleAction.SKILL_OFFENSIVE)
+def _reality_distortion(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Искажение реальности
+    attacker.set_effect("reality_distortion_active", True)
+    return [
+        f">>> {attacker.full_name} использует ИСКАЖЕНИЕ РЕАЛЬНОСТИ!",
+        f"Весь входящий урон увеличен на 35%",
+        f"При использовании противником навыка - взрыв!",
+    ]
+
+
+@register_skill(Warrior, BattleAction.SKILL_OFFENSIVE)
+def _thunder_hammer(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Молот грома
+    raw_damage = int(attacker.attack_power * 0.5)
+    final_damage, _ = battle._apply_damage(defender, raw_damage)
+    defender.set_effect("stunned", True)
+    return [
+        f">>> {attacker.full_name} использует МОЛОТ ГРОМА!",
+        f"Урон: {final_damage}",
+        f"Противник оглушен на 1 ход!",
+        f"{defender.full_name}: {defender.health_points}/{defender.max_health_points} HP",
+    ]
+
+
+@register_skill(Archer, BattleAction.SKILL_OFFENSIVE)
+def _arrow_volley(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Град стрел - 3 атаки по 70%
+    result = [f">>> {attacker.full_name} использует ГРАД СТРЕЛ!"]
+    total_damage = 0
+    for i in range(3):
+        raw_damage, is_crit = attacker.deal_damage(battle.roll)
+        raw_damage = int(raw_damage * 0.7)
+        final_damage, event = battle._apply_damage(defender, raw_damage)
+        total_damage += final_damage
+        crit_text = " [КРИТ!]" if is_crit else ""
+        result.append(f"Стрела {i + 1}: {final_damage} урона{crit_text}")
+        if defender.is_dead() and not defender.state.soulstone_active:
+            break
+    result.append(f"Общий урон: {total_damage}")
+    result.append(f"{defender.full_name}: {defender.health_points}/{defender.max_health_points} HP")
+    return result
+
+
+@register_skill(Warlock, BattleAction.SKILL_OFFENSIVE)
+def _corruption(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Порча
+    attacker.set_effect("corruption_active", True)
+    return [
+        f">>> {attacker.full_name} использует ПОРЧУ!",
+        f"Все атаки теперь накладывают порчу: +30% урона, игнорирует броню",
+        f"Чернокнижник лечится на размер дополнительного урона",
+    ]
+
+
+@register_skill(Paladin, BattleAction.SKILL_DEFENSIVE)
+def _divine_shield(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Божественная защита
+    attacker.set_effect("divine_shield_active", True)
+    return [
+        f">>> {attacker.full_name} использует БОЖЕСТВЕННУЮ ЗАЩИТУ!",
+        f"Следующий входящий урон излечит паладина",
+    ]
+
+
+@register_skill(Mage, BattleAction.SKILL_DEFENSIVE)
+def _alter_time(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Альтертайм
+    result = [f">>> {attacker.full_name} использует АЛЬТЕРТАЙМ!"]
+    if len(attacker.state.hp_history) >= 2:
+        old_hp = attacker.state.hp_history[-2]
+        healed = old_hp - attacker.health_points
+        attacker.health_points = min(old_hp, attacker.max_health_points)
+        result.append(f"HP восстановлено до {attacker.health_points} (+{healed} HP)")
+    else:
+        result.append(f"Недостаточно истории для отката")
+    return result
+
+
+@register_skill(Warrior, BattleAction.SKILL_DEFENSIVE)
+def _shield_wall(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Поднять щиты
+    attacker.set_effect("shield_wall_turns", 2)
+    return [
+        f">>> {attacker.full_name} использует ПОДНЯТЬ ЩИТЫ!",
+        f"Весь входящий урон уменьшен на 60% на следующие 2 хода",
+    ]
+
+
+@register_skill(Archer, BattleAction.SKILL_DEFENSIVE)
+def _hunter_agility(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Ловкость охотника
+    attacker.set_effect("dodge_boost_active", True)
+    return [
+        f">>> {attacker.full_name} использует ЛОВКОСТЬ ОХОТНИКА!",
+        f"Шанс уклонения повышен на 80% на следующий ход",
+    ]
+
+
+@register_skill(Warlock, BattleAction.SKILL_DEFENSIVE)
+def _soulstone(battle: Battle, attacker: Character, defender: Character) -> list[str]:
+    # Камень души
+    attacker.set_effect("soulstone_active", True)
+    return [
+        f">>> {attacker.full_name} использует КАМЕНЬ ДУШИ!",
+        f"При получении смертельного урона - воскрешение с 20% HP",
+    ]
+
+
+# ==================== РАСЧЕТ УРОНА ====================
+@functools.lru_cache(maxsize=8192)
+def _attack_distribution(
+        attack_power: int, crit_chance: float, crit_multiplier: float,
+        holy_charged: bool, corruption_active: bool,
+        defence: int, reality_distortion: bool, divine_shield: bool,
+        dodge_boost: bool, dodge_chance: float,
+) -> tuple[tuple[int, float], ...]:
+    """Точное распределение потери HP от обычной атаки (повторяет _execute_attack)"""
+    distribution = {}
+
+    def add(damage: int, probability: float) -> None:
+        if probability > 0:
+            distribution[damage] = distribution.get(damage, 0.0) + probability
+
+    for multiplier, p_raw in ((crit_multiplier, crit_chance), (1.0, 1 - crit_chance)):
+        raw_damage = round(attack_power * multiplier)
+
+        if holy_charged:
+            # Правосудие света не вычитает HP напрямую, урон наносит только порча
+            add(int(raw_damage * 0.3) if corruption_active else 0, p_raw)
+            continue
+
+        if reality_distortion:
+            raw_damage = int(raw_damage * 1.35)
+
+        if divine_shield:
+            add(0, p_raw)
+            continue
+
+        p_hit = p_raw
+        if dodge_boost:
+            add(0, p_hit * 0.8)
+            p_hit *= 0.2
+        add(0, p_hit * dodge_chance)
+        p_hit *= 1 - dodge_chance
+
+        damage = max(1, round(raw_damage * (100 - defence) / 100))
+        if corruption_active:
+            damage += int(damage * 0.3)
+        add(damage, p_hit)
+
+    return tuple(sorted(distribution.items()))
+
+
+def damage_distribution(attacker: Character, defender: Character) -> dict[int, float]:
+    """Распределение потери HP защитника от атаки: {урон: вероятность}.
+
+    Лечение божественной защитой считается нулевым уроном.
+    """
+    return dict(_attack_distribution(
+        attacker.attack_power, attacker.crit_chance, attacker.crit_multiplier,
+        attacker.state.holy_charged, attacker.state.corruption_active,
+        defender.defence, defender.state.reality_distortion_active, defender.state.divine_shield_active,
+        defender.state.dodge_boost_active, getattr(defender.race, "dodge_chance", 0.0),
+    ))
+
+
+def expected_damage(attacker: Character, defender: Character) -> float:
+    """Математическое ожидание урона атаки"""
+    return sum(damage * probability for damage, probability in damage_distribution(attacker, defender).items())
+
+
+# ==================== ИИ ПРОТИВНИК ====================
+class _SearchTimeout(Exception):
+    pass
+
+
+class ExpectimaxAI:
+    """Компьютерный противник: expectimax с ограничением глубины.
+
+    Узлы случая - броски боя (крит, уклонение эльфа, ловкость охотника),
+    ходы соперника считаются худшими для ИИ.
+    """
+    actions = (
+        BattleAction.ATTACK,
+        BattleAction.BLOCK,
+        BattleAction.SKILL_OFFENSIVE,
+        BattleAction.SKILL_DEFENSIVE,
+    )
+    win_score = 1000.0
+
+    def __init__(self, max_depth: int = 6, time_budget: float = 0.02, table_size: int = 200_000):
+        self.max_depth = max_depth
+        self.time_budget = time_budget  # секунд на ход
+        self.table_size = table_size
+        self.table = {}  # транспозиционная таблица
+
+    def choose_action(self, battle: Battle, player: int) -> str:
+        """Лучшее действие для игрока player. Бой восстанавливается после поиска"""
+        if len(self.table) > self.table_size:
+            self.table.clear()
+
+        deadline = time.perf_counter() + self.time_budget
+        signature = tuple(
+            (type(c.race).__name__, type(c.char_class).__name__, c.level)
+            for c in (battle.char1, battle.char2)
+        )
+        snap = battle.snapshot()
+        best = BattleAction.ATTACK
+
+        # Итеративное углубление: при нехватке времени берется последний полный результат
+        try:
+            for depth in range(1, self.max_depth + 1):
+                best = self._search_root(battle, player, depth, deadline, signature)
+        except _SearchTimeout:
+            pass
+        finally:
+            battle.__dict__.pop("roll", None)
+            battle.restore(snap)
+
+        return best
+
+    def _legal_actions(self, battle: Battle) -> tuple[str, ...]:
+        if battle.get_current_character().state.skill_used:
+            return self.actions[:2]
+        return self.actions
+
+    def _state_key(self, battle: Battle) -> tuple:
+        return battle.current_player, battle.char1.snapshot(), battle.char2.snapshot()
+
+    def _search_root(self, battle, player, depth, deadline, signature) -> str:
+        best_action, best_value = None, None
+        for action in self._legal_actions(battle):
+            value = self._expect(battle, action, player, depth, deadline, signature)
+            if best_value is None or value > best_value:
+                best_action, best_value = action, value
+        return best_action
+
+    def _value(self, battle, player, depth, deadline, signature) -> float:
+        if time.perf_counter() > deadline:
+            raise _SearchTimeout
+
+        winner = battle.get_winner()
+        if winner is not None:
+            # Быстрая победа лучше долгой
+            score = self.win_score + depth
+            return score if winner == player else -score
+
+        if depth == 0:
+            return self._evaluate(battle, player)
+
+        key = (signature, player, depth, self._state_key(battle))
+        cached = self.table.get(key)
+        if cached is not None:
+            return cached
+
+        values = [
+            self._expect(battle, action, player, depth, deadline, signature)
+            for action in self._legal_actions(battle)
+        ]
+        value = max(values) if battle.current_player == player else min(values)
+        self.table[key] = value
+        return value
+
+    def _expect(self, battle, action, player, depth, deadline, signature) -> float:
+        snap = battle.snapshot(with_rng=False)
+        total = 0.0
+        for probability, outcome in self._outcomes(battle, action, deadline):
+            battle.restore(outcome)
+            total += probability * self._value(battle, player, depth - 1, deadline, signature)
+        battle.restore(snap)
+        return total
+
+    def _outcomes(self, battle: Battle, action: str, deadline: float) -> list[tuple[float, tuple]]:
+        """Все исходы действия с вероятностями; одинаковые состояния склеиваются"""
+        snap = battle.snapshot(with_rng=False)
+        outcomes = {}
+        pending = [()]
+
+        while pending:
+            if time.perf_counter() > deadline:
+                raise _SearchTimeout
+
+            forced = pending.pop()
+            path = []
+            probability = 1.0
+
+            def roll(chance: float) -> bool:
+                nonlocal probability
+                index = len(path)
+                if chance <= 0:
+                    hit = False
+                elif chance >= 1:
+                    hit = True
+                else:
+                    if index < len(forced):
+                        hit = forced[index]
+                    else:
+                        hit = True
+                        pending.append(tuple(path) + (False,))
+                    probability *= chance if hit else 1 - chance
+                path.append(hit)
+                return hit
+
+            battle.roll = roll
+            battle.execute_action(action)
+            key = self._state_key(battle)
+            if key in outcomes:
+                outcomes[key][0] += probability
+            else:
+                outcomes[key] = [probability, battle.snapshot(with_rng=False)]
+            battle.restore(snap)
+
+        del battle.roll
+        return [(p, outcome) for p, outcome in outcomes.values()]
+
+    def _evaluate(self, battle: Battle, player: int) -> float:
+        """Оценка позиции: разница долей HP, ожидаемый урон и запас навыков"""
+        me, enemy = (battle.char1, battle.char2) if player == 1 else (battle.char2, battle.char1)
+        score = me.health_points / me.max_health_points - enemy.health_points / enemy.max_health_points
+        score += 0.5 * (
+            expected_damage(me, enemy) / enemy.max_health_points
+            - expected_damage(enemy, me) / me.max_health_points
+        )
+        score += 0.1 * (enemy.state.skill_used - me.state.skill_used)
+        return score
+
+
+AI_PLAYER = 2
+opponent_ai = ExpectimaxAI()
+ai_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ai")
+
+
+async def choose_ai_action(battle: Battle, player: int = AI_PLAYER) -> str:
+    """Поиск хода в рабочем потоке на копии боя, чтобы не блокировать цикл событий"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ai_executor, opponent_ai.choose_action, battle.clone(), player)
+
+
+async def play_ai_turns(battle: Battle) -> list[str]:
+    """Ходы ИИ, пока очередь за ним и бой не окончен"""
+    logs = []
+    while battle.current_player == AI_PLAYER and battle.get_winner() is None:
+        action = await choose_ai_action(battle)
+        logs.append(battle.execute_action(action))
+    return logs
+
+
+# ==================== АВТОБОЙ ====================
+# Политики для боев без участия игроков: (бой, генератор) -> действие
+def random_policy(battle: Battle, rng: random.Random) -> str:
+    if battle.get_current_character().state.skill_used:
+        return rng.choice(ExpectimaxAI.actions[:2])
+    return rng.choice(ExpectimaxAI.actions)
+
+
+def greedy_policy(battle: Battle, rng: random.Random) -> str:
+    """Навык сразу, дальше атака; блок, если следующий удар соперника может добить"""
+    me = battle.get_current_character()
+    enemy = battle.get_opponent()
+
+    if not me.state.skill_used:
+        if me.health_points > me.max_health_points / 2:
+            return BattleAction.SKILL_OFFENSIVE
+        return BattleAction.SKILL_DEFENSIVE
+
+    if me.health_points <= expected_damage(enemy, me) < enemy.health_points:
+        return BattleAction.BLOCK
+    return BattleAction.ATTACK
+
+
+_policy_ai = ExpectimaxAI(max_depth=3, time_budget=0.005)
+
+
+def expectimax_policy(battle: Battle, rng: random.Random) -> str:
+    return _policy_ai.choose_action(battle, battle.current_player)
+
+
+AUTO_POLICIES = {
+    "random": random_policy,
+    "greedy": greedy_policy,
+    "expectimax": expectimax_policy,
+}
+MAX_AUTO_TURNS = 300
+
+
+def auto_battle(char1: Character, char2: Character, policy: str = "greedy", seed: int | None = None) -> int:
+    """Бой до конца по политике policy; возвращает номер победителя.
+
+    Если бой затянулся дольше MAX_AUTO_TURNS, побеждает тот, у кого больше доля HP.
+    """
+    battle = Battle(char1, char2, seed=seed)
+    choose = AUTO_POLICIES[policy]
+    policy_rng = random.Random(seed)
+
+    while battle.current_turn <= MAX_AUTO_TURNS:
+        winner = battle.get_winner()
+        if winner is not None:
+            return winner
+        battle.execute_action(choose(battle, policy_rng))
+
+    return battle.get_winner() or (1 if char1.health_points_percent() >= char2.health_points_percent() else 2)
+
+
 PLAYERS_FILE = "players.json"
 BATTLES_FILE = "active_battles.json"
 
 
+# Версия формата записи игрока; старые записи обновляет migrate_players при запуске
+PLAYER_SCHEMA_VERSION = 3
+
+# Доставка лога завершенного боя: итог + лог одним документом или только итог
+LOG_DELIVERY_MODES = ("document", "summary")
+
+
 @dataclass
 class PlayerProfile:
     tg_id: int
@@ -576,9 +1139,17 @@ class PlayerProfile:
     level: int = 1
     wins: int = 0
     losses: int = 0
+    log_delivery: str = "document"
+    schema_version: int = PLAYER_SCHEMA_VERSION
 
 
 def load_players() -> dict[str, dict]:
+    if PLAYERS_FORMAT == "binary":
+        return BinaryPlayers(PLAYERS_BIN_FILE)
+    return _load_players_json()
+
+
+def _load_players_json() -> dict[str, dict]:
     try:
         with open(PLAYERS_FILE, "r", encoding="utf-8") as f:
             content = f.read().strip()
@@ -595,35 +1166,100 @@ def load_players() -> dict[str, dict]:
         return {}
 
 
+@contextlib.contextmanager
+def _atomic_open(path: str, mode: str = "w"):
+    """Запись во временный файл и атомарная замена: читатели из других
+    процессов никогда не видят наполовину записанный файл"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".players_", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
 def save_players(players: dict[str, dict]) -> None:
-    with open(PLAYERS_FILE, "w", encoding="utf-8") as f:
+    if PLAYERS_FORMAT == "binary":
+        write_players_binary(players, PLAYERS_BIN_FILE)
+        return
+
+    with _atomic_open(PLAYERS_FILE) as f:
         json.dump(players, f, ensure_ascii=False, indent=2)
 
 
-def get_profile(players: dict[str, dict], tg_id: int) -> PlayerProfile | None:
-    data = players.get(str(tg_id))
-    if not data:
-        return None
+@contextlib.contextmanager
+def players_lock():
+    """Межпроцессная блокировка для цепочки load_players -> save_players"""
+    if fcntl is None:
+        yield
+        return
 
-    # Миграция со старого формата
+    with open(PLAYERS_FILE + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _migrate_v1(data: dict) -> None:
+    # Старый формат: раса хранилась в char_class, класс всегда воин
     if "char_class" in data and "race" not in data:
         old_class = data["char_class"]
-        if old_class == "elf":
-            data["race"] = "elf"
-            data["char_class"] = "warrior"
-        elif old_class == "human":
-            data["race"] = "human"
-            data["char_class"] = "warrior"
-        elif old_class == "troll":
-            data["race"] = "troll"
-            data["char_class"] = "warrior"
-        else:
-            data["race"] = "human"
-            data["char_class"] = "warrior"
+        data["race"] = old_class if old_class in ("elf", "human", "troll") else "human"
+        data["char_class"] = "warrior"
+
+
+def _migrate_v2(data: dict) -> None:
+    data.setdefault("log_delivery", "document")
 
-        players[str(tg_id)] = data
-        save_players(players)
 
+# Шаги миграции: версия -> функция, поднимающая запись на следующую версию
+PLAYER_MIGRATIONS = {
+    1: _migrate_v1,
+    2: _migrate_v2,
+}
+
+
+def upgrade_player_record(data: dict) -> bool:
+    """Обновление записи до PLAYER_SCHEMA_VERSION; False, если она уже актуальна"""
+    version = data.get("schema_version", 1)
+    if version >= PLAYER_SCHEMA_VERSION:
+        return False
+
+    while version < PLAYER_SCHEMA_VERSION:
+        PLAYER_MIGRATIONS[version](data)
+        version += 1
+
+    data["schema_version"] = version
+    return True
+
+
+def migrate_players() -> int:
+    """Разовая миграция всех записей при запуске, одна запись файла. Возвращает число обновленных"""
+    with players_lock():
+        players = load_players()
+        if isinstance(players, BinaryPlayers):
+            # Версия схемы бинарного файла хранится в заголовке; при перезаписи
+            # write_binary_records обновляет записи по одной
+            if players.schema_version >= PLAYER_SCHEMA_VERSION:
+                return 0
+            save_players(players)
+            return players.count
+        upgraded = sum(upgrade_player_record(data) for data in players.values())
+        if upgraded:
+            save_players(players)
+    return upgraded
+
+
+def get_profile(players: dict[str, dict], tg_id: int) -> PlayerProfile | None:
+    data = players.get(str(tg_id))
+    if not data:
+        return None
     return PlayerProfile(**data)
 
 
@@ -640,6 +1276,505 @@ def find_profile_by_username(players: dict[str, dict], username: str) -> PlayerP
     return None
 
 
+# Запись профилей под players_lock. Блокировку может надолго держать другой
+# процесс (например, import-players), так что из обработчиков - через asyncio.to_thread
+def store_profile(profile: PlayerProfile) -> None:
+    with players_lock():
+        players = load_players()
+        set_profile(players, profile)
+        save_players(players)
+
+
+def delete_profile(tg_id: int) -> bool:
+    with players_lock():
+        players = load_players()
+        if str(tg_id) not in players:
+            return False
+        del players[str(tg_id)]
+        save_players(players)
+        return True
+
+
+def cycle_log_delivery(tg_id: int) -> PlayerProfile | None:
+    """Следующий режим доставки лога боя; None, если профиля нет"""
+    with players_lock():
+        players = load_players()
+        profile = get_profile(players, tg_id)
+        if profile:
+            index = LOG_DELIVERY_MODES.index(profile.log_delivery)
+            profile.log_delivery = LOG_DELIVERY_MODES[(index + 1) % len(LOG_DELIVERY_MODES)]
+            set_profile(players, profile)
+            save_players(players)
+        return profile
+
+
+# ==================== БИНАРНОЕ ХРАНИЛИЩЕ ====================
+# Формат players.bin: заголовок, записи фиксированной длины, отсортированные
+# по tg_id, и куча строк (имя, username). Файл отображается в память через
+# mmap, поиск игрока - бинарный поиск без разбора всего файла.
+PLAYERS_FORMAT = os.getenv("PLAYERS_FORMAT", "json")  # json | binary
+PLAYERS_BIN_FILE = "players.bin"
+
+RACE_CODES = ("elf", "human", "troll")
+CLASS_CODES = ("warrior", "paladin", "mage", "archer", "warlock")
+
+_BIN_MAGIC = b"RPGP"
+_BIN_FORMAT_VERSION = 2
+# Сигнатура, версия формата, версия схемы записей, число записей, смещение кучи строк
+_BIN_HEADER = struct.Struct("<4sHHQQ")
+# tg_id, раса, класс, уровень, победы, поражения, имя (смещение, длина), username (смещение, длина)
+# Версия 2 добавляет в конец байт режима доставки лога
+_BIN_RECORDS = {
+    1: struct.Struct("<qBBHIIIHIH"),
+    2: struct.Struct("<qBBHIIIHIHB"),
+}
+_BIN_RECORD = _BIN_RECORDS[_BIN_FORMAT_VERSION]
+_BIN_TG_ID = struct.Struct("<q")
+_NO_USERNAME = 0xFFFF
+
+
+def write_players_binary(players, path: str) -> None:
+    """Запись игроков в бинарный формат; записи предварительно обновляются до текущей схемы"""
+    if isinstance(players, BinaryPlayers):
+        records = players.merged_records()
+    else:
+        records = sorted(players.values(), key=lambda d: int(d["tg_id"]))
+    with _atomic_open(path, "wb") as f:
+        write_binary_records(f, records)
+
+
+def write_binary_records(f, records) -> int:
+    """Потоковая запись записей, уже отсортированных по tg_id, в открытый файл.
+
+    Записи идут сразу в файл, куча строк - во временный файл, который
+    дописывается в конец; заголовок пишется последним. Память не зависит от
+    числа записей. Возвращает число записей.
+    """
+    heap = tempfile.TemporaryFile()
+    heap_size = 0
+    count = 0
+
+    def put(text: str) -> tuple[int, int]:
+        nonlocal heap_size
+        raw = text.encode("utf-8")
+        if len(raw) >= _NO_USERNAME:
+            raise ValueError("Слишком длинная строка для бинарного формата")
+        offset = heap_size
+        heap.write(raw)
+        heap_size += len(raw)
+        return offset, len(raw)
+
+    with heap:
+        f.seek(_BIN_HEADER.size)
+        for data in records:
+            data = dict(data)
+            upgrade_player_record(data)
+            name_offset, name_len = put(data["name"])
+            if data.get("username") is None:
+                username_offset, username_len = 0, _NO_USERNAME
+            else:
+                username_offset, username_len = put(data["username"])
+            f.write(_BIN_RECORD.pack(
+                int(data["tg_id"]),
+                RACE_CODES.index(data["race"]),
+                CLASS_CODES.index(data["char_class"]),
+                data.get("level", 1), data.get("wins", 0), data.get("losses", 0),
+                name_offset, name_len, username_offset, username_len,
+                LOG_DELIVERY_MODES.index(data["log_delivery"]),
+            ))
+            count += 1
+
+        heap.seek(0)
+        shutil.copyfileobj(heap, f)
+
+    heap_offset = _BIN_HEADER.size + count * _BIN_RECORD.size
+    f.seek(0)
+    f.write(_BIN_HEADER.pack(_BIN_MAGIC, _BIN_FORMAT_VERSION, PLAYER_SCHEMA_VERSION, count, heap_offset))
+    return count
+
+
+class BinaryPlayers(MutableMapping):
+    """Игроки из players.bin в виде словаря tg_id -> запись.
+
+    Прочитанные и измененные записи живут в changes (None - удалена);
+    save_players переписывает файл целиком.
+    """
+
+    def __init__(self, path: str):
+        self.changes = {}
+        self.count = 0
+        self.heap_offset = 0
+        self.schema_version = PLAYER_SCHEMA_VERSION
+        self._record = _BIN_RECORD
+        self._mm = None
+
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, fmt, self.schema_version, self.count, self.heap_offset = _BIN_HEADER.unpack_from(self._mm)
+        if magic != _BIN_MAGIC or fmt not in _BIN_RECORDS:
+            raise ValueError(f"{path}: неизвестный формат файла игроков")
+        # Старый формат читается как есть; migrate_players перепишет файл в текущем
+        self._record = _BIN_RECORDS[fmt]
+
+    def _tg_id_at(self, index: int) -> int:
+        return _BIN_TG_ID.unpack_from(self._mm, _BIN_HEADER.size + index * self._record.size)[0]
+
+    def _find(self, tg_id: int) -> int:
+        """Индекс записи с tg_id или -1"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._tg_id_at(mid) < tg_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.count and self._tg_id_at(lo) == tg_id else -1
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self.heap_offset + offset
+        return self._mm[start:start + length].decode("utf-8")
+
+    def _decode(self, index: int) -> dict:
+        (tg_id, race, char_class, level, wins, losses,
+         name_offset, name_len, username_offset, username_len, *rest) = self._record.unpack_from(
+            self._mm, _BIN_HEADER.size + index * self._record.size)
+        data = {
+            "tg_id": tg_id,
+            "username": None if username_len == _NO_USERNAME else self._string(username_offset, username_len),
+            "name": self._string(name_offset, name_len),
+            "race": RACE_CODES[race],
+            "char_class": CLASS_CODES[char_class],
+            "level": level,
+            "wins": wins,
+            "losses": losses,
+            "schema_version": self.schema_version,
+        }
+        if rest:
+            data["log_delivery"] = LOG_DELIVERY_MODES[rest[0]]
+        return data
+
+    def __getitem__(self, key: str) -> dict:
+        if key in self.changes:
+            data = self.changes[key]
+            if data is None:
+                raise KeyError(key)
+            return data
+
+        try:
+            index = self._find(int(key))
+        except ValueError:
+            raise KeyError(key) from None
+        if index < 0:
+            raise KeyError(key)
+
+        # Запись кэшируется, чтобы изменения на месте попали в save_players
+        data = self.changes[key] = self._decode(index)
+        return data
+
+    def __setitem__(self, key: str, value: dict) -> None:
+        self.changes[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self.changes[key] = None
+
+    def __iter__(self):
+        for index in range(self.count):
+            key = str(self._tg_id_at(index))
+            if self.changes.get(key, True) is not None:
+                yield key
+        for key, data in list(self.changes.items()):
+            if data is not None and self._find(int(key)) < 0:
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def file_records(self):
+        """Записи файла по возрастанию tg_id без несохраненных изменений; читаются по одной"""
+        for index in range(self.count):
+            yield self._decode(index)
+
+    def merged_records(self):
+        """Записи по возрастанию tg_id с наложенными changes.
+
+        Файл читается по одной записи и в changes не кэшируется, так что
+        сохранение одной правки не разбирает весь файл в память.
+        """
+        # При совпадении tg_id изменение (приоритет 0) идет раньше записи файла
+        changed = sorted((int(key), 0, key) for key in self.changes)
+        stored = ((self._tg_id_at(index), 1, index) for index in range(self.count))
+        merged = heapq.merge(changed, stored)
+        for _, group in itertools.groupby(merged, key=lambda item: item[0]):
+            _, priority, ref = next(group)
+            data = self.changes[ref] if priority == 0 else self._decode(ref)
+            if data is not None:
+                yield data
+
+
+def convert_players(direction: str) -> int:
+    """Конвертация players.json <-> players.bin без потерь. Возвращает число записей"""
+    with players_lock():
+        if direction == "to-binary":
+            players = _load_players_json()
+            write_players_binary(players, PLAYERS_BIN_FILE)
+        else:
+            players = dict(BinaryPlayers(PLAYERS_BIN_FILE))
+            with _atomic_open(PLAYERS_FILE) as f:
+                json.dump(players, f, ensure_ascii=False, indent=2)
+    return len(players)
+
+
+# ==================== ЭКСПОРТ И ИМПОРТ ====================
+# Выгрузка и загрузка профилей по одной записи (NDJSON или CSV). С бинарным
+# хранилищем память постоянна: экспорт читает mmap, импорт сбрасывает пачки
+# в отсортированные временные файлы и сливает их с players.bin за один проход.
+# players.json читается и пишется целиком - это свойство самого формата.
+EXPORT_FORMATS = ("ndjson", "csv")
+PROFILE_FIELDS = [f.name for f in fields(PlayerProfile)]
+_INT_PROFILE_FIELDS = {f.name for f in fields(PlayerProfile) if f.type is int}
+PROGRESS_EVERY = 100_000
+
+
+@dataclass
+class ProfileFilter:
+    races: tuple = ()
+    classes: tuple = ()
+    min_level: int = 1
+    max_level: int = Character.max_level
+
+    def __call__(self, data: dict) -> bool:
+        return (
+            (not self.races or data["race"] in self.races)
+            and (not self.classes or data["char_class"] in self.classes)
+            and self.min_level <= data["level"] <= self.max_level
+        )
+
+
+def profile_from_record(raw: dict) -> dict:
+    """Проверка внешней записи по PlayerProfile; запись текущей схемы или ValueError"""
+    unknown = set(raw) - set(PROFILE_FIELDS)
+    if unknown:
+        raise ValueError(f"лишние поля: {', '.join(sorted(unknown))}")
+
+    data = {}
+    for name, value in raw.items():
+        if value == "" and name == "username":
+            value = None  # в CSV пустая строка
+        elif value == "":
+            continue  # поле со значением по умолчанию
+        elif name in _INT_PROFILE_FIELDS and not isinstance(value, int):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{name}: ожидается целое, получено {value!r}") from None
+        data[name] = value
+
+    missing = [f.name for f in fields(PlayerProfile) if f.name not in data and f.default is dataclasses.MISSING]
+    if missing:
+        raise ValueError(f"нет полей: {', '.join(missing)}")
+    data = asdict(PlayerProfile(**data))
+    upgrade_player_record(data)
+
+    if data["race"] not in RACE_CODES:
+        raise ValueError(f"неизвестная раса {data['race']!r}")
+    if data["char_class"] not in CLASS_CODES:
+        raise ValueError(f"неизвестный класс {data['char_class']!r}")
+    if data["log_delivery"] not in LOG_DELIVERY_MODES:
+        raise ValueError(f"неизвестный режим лога {data['log_delivery']!r}")
+    if not 1 <= data["level"] <= Character.max_level:
+        raise ValueError(f"уровень вне 1..{Character.max_level}: {data['level']}")
+    if data["wins"] < 0 or data["losses"] < 0:
+        raise ValueError("отрицательные победы или поражения")
+    if not isinstance(data["name"], str) or not data["name"]:
+        raise ValueError("пустое имя")
+    if data["username"] is not None and not isinstance(data["username"], str):
+        raise ValueError(f"username: ожидается строка, получено {data['username']!r}")
+    return data
+
+
+class Progress:
+    """Отчет о ходе долгой операции в stderr"""
+
+    def __init__(self, label: str, every: int = PROGRESS_EVERY):
+        self.label = label
+        self.every = every
+        self.count = 0
+        self.started = time.perf_counter()
+
+    def tick(self) -> None:
+        self.count += 1
+        if self.count % self.every == 0:
+            self.report()
+
+    def report(self) -> None:
+        elapsed = time.perf_counter() - self.started
+        print(f"{self.label}: {self.count} записей, {self.count / max(elapsed, 1e-9):.0f}/с", file=sys.stderr)
+
+
+def _open_stream(path: str, mode: str):
+    if path == "-":
+        stream = sys.stdout if "w" in mode else sys.stdin
+        return contextlib.nullcontext(stream)
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def _guess_format(path: str, fmt: str | None) -> str:
+    if fmt:
+        return fmt
+    return "csv" if path.endswith(".csv") else "ndjson"
+
+
+def export_players(path: str, fmt: str | None = None, where: ProfileFilter | None = None) -> int:
+    """Выгрузка профилей в NDJSON или CSV. Возвращает число выгруженных записей"""
+    fmt = _guess_format(path, fmt)
+    where = where or ProfileFilter()
+    progress = Progress("Экспорт")
+
+    if PLAYERS_FORMAT == "binary":
+        records = BinaryPlayers(PLAYERS_BIN_FILE).file_records()
+    else:
+        records = _load_players_json().values()
+
+    exported = 0
+    with _open_stream(path, "w") as out:
+        writer = None
+        if fmt == "csv":
+            writer = csv.DictWriter(out, fieldnames=PROFILE_FIELDS)
+            writer.writeheader()
+        for data in records:
+            progress.tick()
+            data = dict(data)
+            upgrade_player_record(data)
+            if not where(data):
+                continue
+            data = {name: data[name] for name in PROFILE_FIELDS}
+            if writer:
+                writer.writerow(data)
+            else:
+                out.write(json.dumps(data, ensure_ascii=False) + "\n")
+            exported += 1
+
+    progress.report()
+    return exported
+
+
+def _read_records(stream, fmt: str):
+    """(номер строки, сырая запись) по одной; строка, которую не удалось разобрать, дает ValueError"""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for raw in reader:
+            yield reader.line_num, raw
+        return
+
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            raw = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_no, ValueError(f"неверный JSON: {e.msg}")
+            continue
+        yield line_no, raw if isinstance(raw, dict) else ValueError("ожидается объект")
+
+
+def import_players(path: str, fmt: str | None = None, where: ProfileFilter | None = None,
+                   batch_size: int = 50_000, max_errors: int = 10) -> tuple[int, int]:
+    """Загрузка профилей с заменой по tg_id. Возвращает (загружено, отклонено).
+
+    Хранилище меняется одной атомарной заменой в конце: прерванный импорт
+    ничего не портит. Чтение и проверка входного файла идут без players_lock,
+    блокировка берется только на слияние и замену файла.
+    """
+    fmt = _guess_format(path, fmt)
+    where = where or ProfileFilter()
+    progress = Progress("Импорт")
+    rejected = 0
+
+    def batches():
+        nonlocal rejected
+        batch = {}
+        with _open_stream(path, "r") as stream:
+            for line_no, raw in _read_records(stream, fmt):
+                progress.tick()
+                try:
+                    if isinstance(raw, ValueError):
+                        raise raw
+                    data = profile_from_record(raw)
+                except ValueError as e:
+                    rejected += 1
+                    if rejected <= max_errors:
+                        print(f"Строка {line_no}: {e}", file=sys.stderr)
+                    continue
+                if where(data):
+                    batch[data["tg_id"]] = data  # повтор в пачке: побеждает последний
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = {}
+        if batch:
+            yield batch
+
+    if PLAYERS_FORMAT == "binary":
+        imported = _import_binary(batches())
+    else:
+        loaded = {}
+        imported = 0
+        for batch in batches():
+            loaded.update((str(tg_id), data) for tg_id, data in batch.items())
+            imported += len(batch)
+        with players_lock():
+            players = _load_players_json()
+            players.update(loaded)
+            with _atomic_open(PLAYERS_FILE) as f:
+                json.dump(players, f, ensure_ascii=False, indent=2)
+
+    progress.report()
+    return imported, rejected
+
+
+def _import_binary(batches) -> int:
+    """Пачки -> отсортированные временные файлы -> слияние с players.bin.
+
+    Временные файлы пишутся без блокировки; players_lock держится только на
+    слиянии, чтобы правки профилей, сделанные за время импорта, не потерялись.
+    """
+    directory = os.path.dirname(os.path.abspath(PLAYERS_BIN_FILE))
+    imported = 0
+
+    with tempfile.TemporaryDirectory(dir=directory, prefix=".import_") as runs_dir:
+        run_paths = []
+        for batch in batches:
+            run_path = os.path.join(runs_dir, f"run{len(run_paths)}.bin")
+            with open(run_path, "wb") as f:
+                write_binary_records(f, (batch[tg_id] for tg_id in sorted(batch)))
+            run_paths.append(run_path)
+            imported += len(batch)
+
+        with players_lock():
+            # Источники по старшинству: текущий файл, затем пачки по порядку;
+            # при совпадении tg_id остается запись самого позднего источника
+            sources = [BinaryPlayers(PLAYERS_BIN_FILE)] + [BinaryPlayers(p) for p in run_paths]
+            streams = [
+                ((data["tg_id"], priority, data) for data in source.file_records())
+                for priority, source in enumerate(sources)
+            ]
+            merged = heapq.merge(*streams, key=lambda item: item[:2])
+            latest = (list(group)[-1][2] for _, group in itertools.groupby(merged, key=lambda item: item[0]))
+
+            with _atomic_open(PLAYERS_BIN_FILE, "wb") as f:
+                write_binary_records(f, latest)
+
+    return imported
+
+
 def get_race(race_name: str) -> Race:
     race_name = race_name.lower()
     if race_name == "elf":
@@ -707,13 +1842,1074 @@ def stats_to_text(c: Character) -> str:
     return "\n".join(lines)
 
 
+# ==================== ТУРНИРЫ ====================
+def play_match_batch(matches: list[tuple[dict, dict, int]], policy: str) -> list[int]:
+    """Пакет матчей (профиль, профиль, сид) -> победители. Выполняется в пуле процессов"""
+    return [
+        auto_battle(
+            make_character_from_profile(PlayerProfile(**a)),
+            make_character_from_profile(PlayerProfile(**b)),
+            policy, seed,
+        )
+        for a, b, seed in matches
+    ]
+
+
+class Tournament:
+    """Турнир по олимпийской системе или круговой, матчи играются пакетами в пуле процессов"""
+    formats = ("single", "roundrobin")
+
+    def __init__(self, participants: list[dict], fmt: str = "single", policy: str = "greedy",
+                 seed: int | None = None, batch_size: int = 64, max_concurrency: int = 4):
+        self.participants = {p["tg_id"]: p for p in participants}
+        self.fmt = fmt
+        self.policy = policy
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        self.wins = collections.Counter()
+        self.losses = collections.Counter()
+        self.eliminated_in = {}  # tg_id -> номер раунда вылета
+        self.rounds_total = 0
+        self.matches_played = 0
+
+    async def _play(self, executor, pairs: list[tuple[int, int]]) -> list[int]:
+        """Матчи раунда; возвращает tg_id победителей в порядке пар"""
+        loop = asyncio.get_running_loop()
+        matches = [
+            (self.participants[a], self.participants[b], self.rng.getrandbits(32))
+            for a, b in pairs
+        ]
+
+        async def run_batch(batch):
+            async with self.semaphore:
+                return await loop.run_in_executor(executor, play_match_batch, batch, self.policy)
+
+        batches = [matches[i:i + self.batch_size] for i in range(0, len(matches), self.batch_size)]
+        results = await asyncio.gather(*(run_batch(batch) for batch in batches))
+
+        winners = []
+        for (a, b), winner in zip(pairs, itertools.chain.from_iterable(results)):
+            winner_id, loser_id = (a, b) if winner == 1 else (b, a)
+            self.wins[winner_id] += 1
+            self.losses[loser_id] += 1
+            winners.append(winner_id)
+        self.matches_played += len(pairs)
+        return winners
+
+    async def run(self, executor, on_round=None) -> list[int]:
+        """Проведение турнира; on_round(раунд, выбывшие) вызывается после каждого раунда.
+
+        Возвращает tg_id участников по местам.
+        """
+        players = list(self.participants)
+        self.rng.shuffle(players)
+
+        if self.fmt == "roundrobin":
+            rounds = self.roundrobin_rounds(players)
+            self.rounds_total = len(rounds)
+            for round_no, pairs in enumerate(rounds, 1):
+                await self._play(executor, pairs)
+                if on_round:
+                    await on_round(round_no, [])
+            return sorted(players, key=lambda p: (-self.wins[p], self.losses[p]))
+
+        self.rounds_total = max(1, (len(players) - 1).bit_length())
+        alive = players
+        had_bye = set()
+        round_no = 0
+        while len(alive) > 1:
+            round_no += 1
+            # Нечетный участник проходит дальше без боя; второй раз - только если
+            # без боя уже проходили все
+            bye = []
+            if len(alive) % 2:
+                index = next((i for i in reversed(range(len(alive))) if alive[i] not in had_bye), -1)
+                bye = [alive.pop(index)]
+                had_bye.add(bye[0])
+            pairs = list(zip(alive[0::2], alive[1::2]))
+            winners = await self._play(executor, pairs)
+
+            won = set(winners)
+            out = [p for pair in pairs for p in pair if p not in won]
+            for p in out:
+                self.eliminated_in[p] = round_no
+            alive = winners + bye
+
+            if on_round:
+                await on_round(round_no, out)
+
+        return alive + sorted(self.eliminated_in, key=self.eliminated_in.get, reverse=True)
+
+    @staticmethod
+    def roundrobin_rounds(players: list[int]) -> list[list[tuple[int, int]]]:
+        """Круговая система по кругу Бергера: в каждом раунде каждый играет не больше одного матча"""
+        ring = players + [None] if len(players) % 2 else list(players)
+        n = len(ring)
+        rounds = []
+        for _ in range(n - 1):
+            pairs = [(ring[i], ring[n - 1 - i]) for i in range(n // 2)]
+            rounds.append([(a, b) for a, b in pairs if a is not None and b is not None])
+            # Первый участник на месте, остальные сдвигаются по кругу
+            ring = [ring[0], ring[-1]] + ring[1:-1]
+        return rounds
+
+    def save_results(self) -> None:
+        """Победы и поражения всех участников одной записью файла"""
+        with players_lock():
+            players = load_players()
+            for tg_id in self.wins.keys() | self.losses.keys():
+                data = players.get(str(tg_id))
+                if data:
+                    data["wins"] = data.get("wins", 0) + self.wins[tg_id]
+                    data["losses"] = data.get("losses", 0) + self.losses[tg_id]
+            save_players(players)
+
+
+_tournament_executor = None
+
+
+def get_tournament_executor() -> ProcessPoolExecutor:
+    global _tournament_executor
+    if _tournament_executor is None:
+        _tournament_executor = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) - 1))
+    return _tournament_executor
+
+
+def shutdown_tournament_executor() -> None:
+    """Остановка пула турниров. Процесс-воркер шарда иначе ждет процессы пула на выходе вечно"""
+    global _tournament_executor
+    if _tournament_executor is not None:
+        _tournament_executor.shutdown(wait=True, cancel_futures=True)
+        _tournament_executor = None
+
+
+# ==================== БАЛАНС ====================
+# Подбор констант рас и классов, при котором каждая пара раса×класс против
+# раса×класс выигрывает около 50%. Кандидаты - точки сетки; оценка - пакеты
+# автобоев в пуле процессов. Сиды боев общие для всех кандидатов, поэтому
+# кандидатов честно сравнивать даже на коротком прогоне.
+BALANCE_TARGETS = {cls.__name__: cls for cls in (Elf, Human, Troll, Warrior, Paladin, Mage, Archer, Warlock)}
+# Атрибут -> (шаг сетки, минимум, максимум)
+BALANCE_PARAMS = {
+    "base_health_points": (5, 50, 200),
+    "crit_chance": (0.02, 0.0, 0.5),
+    "crit_multiplier": (0.1, 1.0, 3.5),
+    "base_health_modifier": (0.05, 0.5, 1.6),
+    "base_attack_modifier": (0.05, 0.5, 1.6),
+}
+BALANCE_COMBOS = [(race, cls) for race in RACE_CODES for cls in CLASS_CODES]
+BALANCE_PAIRS = list(itertools.combinations(range(len(BALANCE_COMBOS)), 2))
+
+
+def balance_params() -> dict[str, float]:
+    """Текущие значения настраиваемых констант: "Класс.атрибут" -> значение"""
+    return {
+        f"{name}.{attr}": getattr(target, attr)
+        for name, target in BALANCE_TARGETS.items()
+        for attr in BALANCE_PARAMS
+        if hasattr(target, attr)
+    }
+
+
+def apply_balance(params: dict[str, float]) -> None:
+    for key, value in params.items():
+        name, attr = key.split(".")
+        setattr(BALANCE_TARGETS[name], attr, value)
+
+
+def _clamp(attr: str, value: float) -> float:
+    """Значение в допустимых границах; округление делает ключи кэша устойчивыми"""
+    step, low, high = BALANCE_PARAMS[attr]
+    value = min(high, max(low, value))
+    return int(value) if isinstance(step, int) else round(value, 4)
+
+
+def simulate_matchups(params: dict[str, float], pairs: list[tuple[int, int]], games: range,
+                      level: int, policy: str, seed: int) -> list[int]:
+    """Победы первого из пары в боях с номерами games. Выполняется в пуле процессов"""
+    apply_balance(params)
+    wins = []
+    for a, b in pairs:
+        (race_a, class_a), (race_b, class_b) = BALANCE_COMBOS[a], BALANCE_COMBOS[b]
+        wins.append(sum(
+            auto_battle(
+                Character(get_race(race_a), get_class(class_a), level),
+                Character(get_race(race_b), get_class(class_b), level),
+                policy, ((seed * 1000 + a) * 1000 + b) * 1_000_000 + game,
+            ) == 1
+            for game in games
+        ))
+    return wins
+
+
+class BalanceTuner:
+    """Покоординатный спуск по сетке констант с отсевом и кэшем оцененных точек.
+
+    Цель - среднеквадратичное отклонение винрейтов пар от 50%. На каждом шаге
+    каждый параметр сдвигается на свой шаг в обе стороны от текущего
+    значения (сетка привязана к исходным константам). Соседи сначала
+    играют screen_games боев на пару; кандидаты не лучше текущей точки на тех
+    же сидах отбрасываются, остальные доигрываются до games.
+    """
+
+    def __init__(self, executor, games: int = 100, screen_games: int = 25, level: int = 3,
+                 policy: str = "greedy", tolerance: float = 0.05, seed: int = 0,
+                 finalists: int = 4, chunk_size: int = 15):
+        self.executor = executor
+        self.level = level
+        self.policy = policy
+        self.tolerance = tolerance
+        self.seed = seed
+        self.finalists = finalists
+        self.chunk_size = chunk_size
+        # Этапы оценки: короткий отсев и доигровка до полного числа боев
+        screen_games = min(screen_games, games)
+        self.stages = [range(0, screen_games), range(screen_games, games)]
+        self.cache = {}  # точка -> победы по парам для каждого сыгранного этапа
+        self.battles_played = 0
+
+    @staticmethod
+    def key(params: dict[str, float]) -> tuple:
+        return tuple(sorted(params.items()))
+
+    def evaluate(self, candidates: list[dict[str, float]], stages: int) -> None:
+        """Доигрывает кандидатов до stages этапов; задачи всех кандидатов идут в пул разом"""
+        jobs = []
+        for params in candidates:
+            done = self.cache.setdefault(self.key(params), [])
+            for games in self.stages[len(done):stages]:
+                wins = [0] * len(BALANCE_PAIRS)
+                done.append(wins)
+                for start in range(0, len(BALANCE_PAIRS), self.chunk_size):
+                    future = self.executor.submit(
+                        simulate_matchups, params, BALANCE_PAIRS[start:start + self.chunk_size],
+                        games, self.level, self.policy, self.seed)
+                    jobs.append((wins, start, future))
+                self.battles_played += len(games) * len(BALANCE_PAIRS)
+
+        for wins, start, future in jobs:
+            wins[start:start + self.chunk_size] = future.result()
+
+    def win_rates(self, params: dict[str, float], stages: int | None = None) -> list[float]:
+        done = self.cache[self.key(params)][:stages]
+        games = sum(len(g) for g in self.stages[:len(done)])
+        return [sum(column) / games for column in zip(*done)]
+
+    def objective(self, params: dict[str, float], stages: int | None = None) -> float:
+        rates = self.win_rates(params, stages)
+        return sum((r - 0.5) ** 2 for r in rates) / len(rates)
+
+    def outliers(self, params: dict[str, float]) -> int:
+        return sum(abs(r - 0.5) > self.tolerance for r in self.win_rates(params))
+
+    def neighbours(self, params: dict[str, float]) -> list[dict[str, float]]:
+        result = []
+        for key, value in params.items():
+            attr = key.split(".")[1]
+            for direction in (-1, 1):
+                moved = _clamp(attr, value + direction * BALANCE_PARAMS[attr][0])
+                if moved != value:
+                    result.append({**params, key: moved})
+        return result
+
+    def run(self, start: dict[str, float], max_iters: int = 20, log=print) -> dict[str, float]:
+        current = dict(start)
+        self.evaluate([current], len(self.stages))
+        log(f"Старт: отклонение {self.objective(current) ** 0.5:.3f}, пар вне допуска {self.outliers(current)}")
+
+        for iteration in range(1, max_iters + 1):
+            if not self.outliers(current):
+                log("Все пары в пределах допуска")
+                break
+
+            candidates = self.neighbours(current)
+            self.evaluate(candidates, 1)
+            baseline = self.objective(current, 1)
+            screened = sorted(
+                (p for p in candidates if self.objective(p, 1) < baseline),
+                key=lambda p: self.objective(p, 1),
+            )[:self.finalists]
+
+            self.evaluate(screened, len(self.stages))
+            best = min(screened, key=self.objective, default=None)
+            if best is None or self.objective(best) >= self.objective(current):
+                log(f"Шаг {iteration}: улучшений нет, остановка")
+                break
+
+            changed = next(key for key in best if best[key] != current[key])
+            log(f"Шаг {iteration}: {changed} {current[changed]} -> {best[changed]}, "
+                f"отклонение {self.objective(best) ** 0.5:.3f}, пар вне допуска {self.outliers(best)}, "
+                f"доиграно {len(screened)}/{len(candidates)}")
+            current = best
+
+        return current
+
+
+def _combo_label(index: int) -> str:
+    race, cls = BALANCE_COMBOS[index]
+    return f"{race[:2]}-{cls[:4]}"
+
+
+def format_matchups(rates: list[float]) -> str:
+    """Матрица винрейтов строки против столбца в процентах"""
+    size = len(BALANCE_COMBOS)
+    matrix = [[None] * size for _ in range(size)]
+    for (a, b), rate in zip(BALANCE_PAIRS, rates):
+        matrix[a][b], matrix[b][a] = rate, 1 - rate
+
+    lines = [" " * 8 + "".join(f"{_combo_label(i):>8}" for i in range(size))]
+    for i, row in enumerate(matrix):
+        lines.append(f"{_combo_label(i):<8}" + "".join(f"{'-':>8}" if r is None else f"{r * 100:>8.0f}" for r in row))
+    return "\n".join(lines)
+
+
+def tune_balance(games: int = 100, screen_games: int = 25, level: int = 3, policy: str = "greedy",
+                 tolerance: float = 0.05, max_iters: int = 20, workers: int | None = None,
+                 seed: int = 0, output: str | None = None) -> dict[str, float]:
+    """Подбор констант и отчет: таблица было/стало и матрицы до и после"""
+    started = time.perf_counter()
+    before = balance_params()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tuner = BalanceTuner(executor, games, screen_games, level, policy, tolerance, seed)
+        after = tuner.run(before, max_iters)
+
+    print("\nПРЕДЛАГАЕМЫЕ КОНСТАНТЫ")
+    print(f"{'параметр':<34}{'было':>8}{'стало':>8}")
+    for key, value in before.items():
+        if after[key] != value:
+            print(f"{key:<34}{value:>8}{after[key]:>8}")
+
+    for title, params in (("ДО", before), ("ПОСЛЕ", after)):
+        print(f"\nВИНРЕЙТЫ {title} (строка против столбца, %), "
+              f"отклонение {tuner.objective(params) ** 0.5:.3f}, пар вне ±{tolerance:.0%}: {tuner.outliers(params)}")
+        print(format_matchups(tuner.win_rates(params)))
+
+    print(f"\nБоев сыграно: {tuner.battles_played}, точек в кэше: {len(tuner.cache)}, "
+          f"время {time.perf_counter() - started:.1f} с")
+
+    if output:
+        with _atomic_open(output) as f:
+            json.dump({"before": before, "after": after}, f, ensure_ascii=False, indent=2)
+    return after
+
+
+# ==================== СПЯЩИЕ БОИ ====================
+# Бой, который долго ждет нажатия, упаковывается в bytes: числовое состояние
+# персонажей, сид генератора и сжатый лог. Живой бой с двумя Character,
+# генератором Mersenne Twister (2.5 КБ) и списком строк лога занимает на
+# порядок больше. При следующем обращении бой распаковывается.
+BATTLE_IDLE_SECONDS = float(os.getenv("BATTLE_IDLE_SECONDS", "60"))
+
+# ID боя, текущий игрок, номер хода, сид генератора
+_PACK_HEADER = struct.Struct("<8sBIQ")
+# Раса, класс, уровень, HP, блок, ходы "Поднять щиты", 7 флагов эффектов, навык использован, длина истории HP
+_PACK_CHARACTER = struct.Struct("<BBBi?B????????B")
+_PACK_HP = struct.Struct("<i")
+_LOG_SEPARATOR = "\0"  # записи лога многострочные
+
+
+def _pack_character(c: Character) -> bytes:
+    *flags, history = c.state.as_tuple()
+    return _PACK_CHARACTER.pack(
+        RACE_CODES.index(type(c.race).__name__.lower()),
+        CLASS_CODES.index(type(c.char_class).__name__.lower()),
+        c.level, c.health_points, *flags, len(history),
+    ) + b"".join(_PACK_HP.pack(hp) for hp in history)
+
+
+def _unpack_character(data: bytes, offset: int) -> tuple[Character, int]:
+    race, char_class, level, hp, *flags, history_len = _PACK_CHARACTER.unpack_from(data, offset)
+    offset += _PACK_CHARACTER.size
+    history = [_PACK_HP.unpack_from(data, offset + i * _PACK_HP.size)[0] for i in range(history_len)]
+    c = Character(get_race(RACE_CODES[race]), get_class(CLASS_CODES[char_class]), level)
+    c.restore((hp, (*flags, history)))
+    return c, offset + history_len * _PACK_HP.size
+
+
+def pack_battle(battle: Battle) -> bytes:
+    """Компактное представление боя.
+
+    Вместо состояния генератора сохраняется сид, взятый из самого генератора:
+    после распаковки бой продолжается с новой, но так же детерминированной
+    последовательностью бросков.
+    """
+    log = zlib.compress(_LOG_SEPARATOR.join(battle.log).encode("utf-8"))
+    return b"".join((
+        _PACK_HEADER.pack(battle.battle_id.encode("ascii"), battle.current_player,
+                          battle.current_turn, battle.rng.getrandbits(64)),
+        _pack_character(battle.char1),
+        _pack_character(battle.char2),
+        log,
+    ))
+
+
+def unpack_battle(data: bytes) -> Battle:
+    battle_id, current_player, current_turn, seed = _PACK_HEADER.unpack_from(data)
+    battle = Battle.__new__(Battle)
+    battle.battle_id = battle_id.decode("ascii")
+    battle.current_player = current_player
+    battle.current_turn = current_turn
+    battle.rng = random.Random(seed)
+    battle.char1, offset = _unpack_character(data, _PACK_HEADER.size)
+    battle.char2, offset = _unpack_character(data, offset)
+    battle.log = zlib.decompress(data[offset:]).decode("utf-8").split(_LOG_SEPARATOR)
+    return battle
+
+
+class BattleTable(MutableMapping):
+    """Бои по tg_id: живые - в live, простаивающие - упакованными в packed.
+
+    Чтение упакованного боя прозрачно распаковывает его; `in`, len и обход
+    ключей бои не распаковывают.
+    """
+
+    def __init__(self, name: str, idle_after: float = BATTLE_IDLE_SECONDS):
+        self.name = name  # метка table в метриках
+        self.idle_after = idle_after
+        self.live = collections.OrderedDict()  # tg_id -> Battle, от давно не тронутых к свежим
+        self.used = {}  # tg_id -> время последнего обращения
+        self.packed = {}  # tg_id -> bytes
+
+    def __getitem__(self, tg_id: int) -> Battle:
+        battle = self.live.get(tg_id)
+        if battle is None:
+            data = self.packed.pop(tg_id)
+            battle = unpack_battle(data)
+            metrics["battles_rehydrated_total"] += 1
+        self._touch(tg_id, battle)
+        return battle
+
+    def __setitem__(self, tg_id: int, battle: Battle) -> None:
+        self.packed.pop(tg_id, None)
+        self._touch(tg_id, battle)
+
+    def __delitem__(self, tg_id: int) -> None:
+        if self.live.pop(tg_id, None) is None:
+            del self.packed[tg_id]
+        self.used.pop(tg_id, None)
+
+    def __contains__(self, tg_id) -> bool:
+        return tg_id in self.live or tg_id in self.packed
+
+    def __iter__(self):
+        yield from list(self.live)
+        yield from list(self.packed)
+
+    def __len__(self) -> int:
+        return len(self.live) + len(self.packed)
+
+    def _touch(self, tg_id: int, battle: Battle) -> None:
+        self.live[tg_id] = battle
+        self.live.move_to_end(tg_id)
+        self.used[tg_id] = time.monotonic()
+
+    def peek(self, tg_id: int) -> Battle:
+        """Бой без распаковки на месте (копия для упакованного)"""
+        battle = self.live.get(tg_id)
+        return battle if battle is not None else unpack_battle(self.packed[tg_id])
+
+    def hibernate_idle(self, now: float | None = None) -> int:
+        """Упаковка боев, не тронутых дольше idle_after. Возвращает число упакованных.
+
+        Обработчик держит бой не дольше нескольких секунд, так что бой,
+        молчащий idle_after, никем не используется.
+        """
+        now = time.monotonic() if now is None else now
+        packed = 0
+        while self.live:
+            tg_id = next(iter(self.live))
+            if now - self.used[tg_id] < self.idle_after:
+                break
+            self.packed[tg_id] = pack_battle(self.live.pop(tg_id))
+            del self.used[tg_id]
+            packed += 1
+        metrics["battles_hibernated_total"] += packed
+        metrics[f'battles_hibernated{{table="{self.name}"}}'] = len(self.packed)
+        return packed
+
+    async def hibernate_loop(self) -> None:
+        """Фоновая упаковка простаивающих боев"""
+        while True:
+            await asyncio.sleep(max(1.0, self.idle_after / 4))
+            self.hibernate_idle()
+
+
 # Хранилище активных боев
-active_battles = {}
+active_battles = BattleTable("active")
 user_creation_state = {}
 
 
+# ==================== МЕТРИКИ ====================
+metrics = collections.Counter()
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
+
+def format_metrics() -> str:
+    """Метрики в текстовом формате Prometheus"""
+    lines = [f"{name} {value}" for name, value in sorted(metrics.items())]
+
+    total = metrics["battle_callbacks_total"]
+    if total:
+        lines.append(f"battle_callbacks_duplicate_ratio {metrics['battle_callbacks_duplicate_total'] / total:.4f}")
+
+    return "\n".join(lines)
+
+
+class RecentIds:
+    """Окно последних идентификаторов фиксированного размера с проверкой за O(1)"""
+
+    def __init__(self, size: int):
+        self.order = collections.deque(maxlen=size)
+        self.ids = set()
+
+    def add(self, item) -> bool:
+        """Добавляет item; False, если он уже есть в окне"""
+        if item in self.ids:
+            return False
+        if len(self.order) == self.order.maxlen:
+            self.ids.discard(self.order[0])
+        self.order.append(item)
+        self.ids.add(item)
+        return True
+
+
+recent_callbacks = RecentIds(4096)
+
+
+class CallbackThrottle:
+    """Ограничение частоты нажатий на пользователя: ведро токенов плюс антидребезг.
+
+    Повтор той же кнопки в окне debounce сливается с предыдущим нажатием,
+    остальные нажатия тратят токены. Состояние - LRU-словарь не больше
+    max_users записей; запись, простоявшая дольше полного восстановления
+    ведра, ничем не отличается от новой и удаляется.
+    """
+
+    def __init__(self, rate: float, burst: int, debounce: float, max_users: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.debounce = debounce
+        self.max_users = max_users
+        self.ttl = max(burst / rate, debounce)
+        self.users = collections.OrderedDict()  # tg_id -> [токены, время, последние данные, время нажатия]
+
+    def check(self, tg_id: int, data: str, now: float | None = None) -> str | None:
+        """None - нажатие обрабатывается; "debounced" или "throttled" - отбрасывается"""
+        now = time.monotonic() if now is None else now
+        state = self.users.pop(tg_id, None)
+        if state is None or now - state[1] > self.ttl:
+            state = [float(self.burst), now, None, float("-inf")]
+        self.users[tg_id] = state
+        self._expire(now)
+
+        tokens, updated, last_data, last_press = state
+        if data == last_data and now - last_press < self.debounce:
+            return "debounced"
+
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            state[0], state[1] = tokens, now
+            return "throttled"
+
+        state[:] = [tokens - 1, now, data, now]
+        return None
+
+    def _expire(self, now: float) -> None:
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+        # Самые старые записи в начале: снимаем устаревшие, пока не встретим свежую
+        while self.users:
+            tg_id, state = next(iter(self.users.items()))
+            if now - state[1] <= self.ttl:
+                break
+            del self.users[tg_id]
+
+
+callback_throttle = CallbackThrottle(
+    rate=float(os.getenv("CALLBACK_RATE", "3")),
+    burst=int(os.getenv("CALLBACK_BURST", "5")),
+    debounce=float(os.getenv("CALLBACK_DEBOUNCE_MS", "300")) / 1000,
+)
+
+
+def check_battle_callback(query, tg_id: int) -> tuple[Battle | None, str | None, str | None]:
+    """Проверка нажатия боевой кнопки до изменения боя.
+
+    Возвращает (бой, действие, None) или (None, None, причина отказа).
+    """
+    metrics["battle_callbacks_total"] += 1
+
+    if not recent_callbacks.add(query.id):
+        metrics["battle_callbacks_duplicate_total"] += 1
+        return None, None, "Нажатие уже обработано"
+
+    battle = active_battles.get(tg_id)
+    if battle is None:
+        return None, None, "Бой не найден! Начни новый бой."
+
+    # battle_action_<действие>:<id боя>:<номер хода>
+    action, _, rest = query.data.replace("battle_action_", "").partition(":")
+    battle_id, _, turn = rest.partition(":")
+    if battle_id != battle.battle_id or turn != str(battle.current_turn):
+        metrics["battle_callbacks_stale_total"] += 1
+        return None, None, "Кнопка устарела"
+    if battle.current_player == AI_PLAYER:
+        return None, None, "Сейчас ход противника"
+
+    return battle, action, None
+
+
+# ==================== ЗРИТЕЛИ ====================
+# Владелец боя по его ID: зрители ищут бой через эту таблицу
+battle_owners = {}
+
+
+class _Watcher:
+    """Зритель: слот последнего кадра вместо очереди, промежуточные кадры теряются"""
+    __slots__ = ("chat_id", "frame", "final", "ready", "message_id", "task")
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.frame = None
+        self.final = False
+        self.ready = asyncio.Event()
+        self.message_id = None
+        self.task = None
+
+
+class SpectatorHub:
+    """Рассылка кадров боя зрителям.
+
+    publish() не ждет отправки: кадр кладется в слот каждого зрителя, а
+    отправкой занимается задача зрителя. Медленный зритель получает только
+    последний кадр, и ходы игроков от зрителей не зависят.
+    """
+
+    def __init__(self, max_watchers: int = 1000, send_concurrency: int = 20):
+        self.max_watchers = max_watchers
+        self.watchers = {}  # battle_id -> {chat_id: _Watcher}
+        self.tasks = set()  # задачи доставки, включая дописывающие финальный кадр
+        self.send_limit = asyncio.Semaphore(send_concurrency)
+
+    def watch(self, bot, battle_id: str, chat_id: int) -> bool:
+        watchers = self.watchers.setdefault(battle_id, {})
+        if chat_id in watchers:
+            return True
+        if len(watchers) >= self.max_watchers:
+            return False
+
+        watcher = watchers[chat_id] = _Watcher(chat_id)
+        watcher.task = asyncio.create_task(self._deliver(bot, battle_id, watcher))
+        self.tasks.add(watcher.task)
+        watcher.task.add_done_callback(self.tasks.discard)
+        metrics["spectators_active"] += 1
+        return True
+
+    def unwatch(self, battle_id: str, chat_id: int) -> None:
+        watcher = self.watchers.get(battle_id, {}).pop(chat_id, None)
+        if watcher:
+            watcher.task.cancel()
+            metrics["spectators_active"] -= 1
+
+    def publish(self, battle_id: str, text: str, final: bool = False) -> None:
+        """Новый кадр для всех зрителей боя; текст рендерится один раз вызывающим"""
+        watchers = self.watchers.get(battle_id)
+        if not watchers:
+            return
+        if final:
+            del self.watchers[battle_id]
+
+        for watcher in watchers.values():
+            if watcher.frame is not None:
+                metrics["spectator_frames_dropped_total"] += 1
+            watcher.frame = text
+            watcher.final = final
+            watcher.ready.set()
+
+    async def drain(self, text: str) -> None:
+        """Финальный кадр text всем зрителям и ожидание всех отправок"""
+        for battle_id in list(self.watchers):
+            self.publish(battle_id, text, final=True)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def queue_depth(self) -> int:
+        """Число кадров, ожидающих отправки"""
+        return sum(w.frame is not None for watchers in self.watchers.values() for w in watchers.values())
+
+    async def _deliver(self, bot, battle_id: str, watcher: _Watcher) -> None:
+        try:
+            while True:
+                await watcher.ready.wait()
+                watcher.ready.clear()
+                text, final = watcher.frame, watcher.final
+                watcher.frame = None
+
+                async with self.send_limit:
+                    with contextlib.suppress(Exception):  # Зритель мог закрыть чат
+                        if watcher.message_id is None or final:
+                            message = await bot.send_message(watcher.chat_id, text[:4096])
+                            watcher.message_id = message.message_id
+                        else:
+                            await bot.edit_message_text(
+                                text[:4096], chat_id=watcher.chat_id, message_id=watcher.message_id)
+                metrics["spectator_frames_sent_total"] += 1
+
+                if final:
+                    return
+        finally:
+            if watcher.final:
+                metrics["spectators_active"] -= 1
+
+
+spectators = SpectatorHub()
+
+
+# ==================== ПАМЯТЬ ====================
+MEMSTATS_SAMPLE = 50  # сколько объектов измерять в больших коллекциях
+MEMSTATS_TOP = 10
+_SIZE_SKIP_TYPES = (
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+    asyncio.AbstractEventLoop, asyncio.Future,
+)
+_last_memory_snapshot = None
+
+
+def deep_sizeof(obj, seen: set | None = None) -> int:
+    """Приблизительный размер объекта вместе со всем, что он держит"""
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, _SIZE_SKIP_TYPES):
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(item)
+
+        if hasattr(item, "__dict__"):
+            stack.append(vars(item))
+        for slot in getattr(type(item), "__slots__", ()):
+            if hasattr(item, slot):
+                stack.append(getattr(item, slot))
+
+    return total
+
+
+def _shared_ids() -> set:
+    """Общие для всех персонажей структуры эффектов не считаются в размере боя"""
+    seen = set()
+    deep_sizeof((EFFECTS, _compiled_effects), seen)
+    return seen
+
+
+def sampled_sizeof(items: list, sample: int = MEMSTATS_SAMPLE) -> tuple[int, list[tuple[int, object]]]:
+    """Оценка суммарного размера по случайной выборке; возвращает (оценка, [(размер, объект)])"""
+    if not items:
+        return 0, []
+    shared = _shared_ids()
+    chosen = random.sample(items, min(sample, len(items)))
+    sized = [(deep_sizeof(item, set(shared)), item) for item in chosen]
+    mean = sum(size for size, _ in sized) / len(sized)
+    return int(mean * len(items)), sized
+
+
+def sampled_container_sizeof(container) -> int:
+    """Сама коллекция плюс оценка ее элементов (ключей и значений словаря) по выборке"""
+    size = sys.getsizeof(container) + sampled_sizeof(list(container))[0]
+    if isinstance(container, dict):
+        size += sampled_sizeof(list(container.values()))[0]
+    return size
+
+
+def memory_breakdown() -> dict[str, int]:
+    """Оценка памяти по подсистемам в байтах; заодно обновляет метрики.
+
+    Большие коллекции оцениваются по выборке: обход целиком на сотнях тысяч
+    объектов занимает почти секунду. Вызывать через asyncio.to_thread.
+    """
+    battles_total, _ = sampled_sizeof(list(active_battles.live.values()))
+    table_keys = list(opponent_ai.table.items())
+    breakdown = {
+        "active_battles": battles_total,
+        "hibernated_battles": sum(sys.getsizeof(data) for data in active_battles.packed.values()),
+        "arena_battles": sampled_sizeof(list(arena.battles.live.values()))[0]
+        + sum(sys.getsizeof(data) for data in arena.battles.packed.values()),
+        # Ключи и сроки в entries те же объекты, что в куче: свои у entries только кортежи
+        "deadline_heap": sampled_container_sizeof(deadlines.heap) + sys.getsizeof(deadlines.entries)
+        + len(deadlines.entries) * sys.getsizeof((0.0, 0, None)),
+        "user_creation_state": deep_sizeof(user_creation_state),
+        "ai_transposition_table": sampled_sizeof(table_keys)[0],
+        "spectator_frames": sum(
+            sys.getsizeof(w.frame) for watchers in spectators.watchers.values()
+            for w in watchers.values() if w.frame is not None
+        ),
+        "recent_callbacks": sampled_container_sizeof(recent_callbacks.order) + sys.getsizeof(recent_callbacks.ids),
+        "callback_throttle": sampled_container_sizeof(callback_throttle.users),
+    }
+    for subsystem, size in breakdown.items():
+        metrics[f'memory_bytes{{subsystem="{subsystem}"}}'] = size
+    return breakdown
+
+
+def memory_report(top: int = MEMSTATS_TOP) -> str:
+    global _last_memory_snapshot
+
+    lines = ["ПАМЯТЬ", ""]
+    for subsystem, size in memory_breakdown().items():
+        lines.append(f"{subsystem}: {size / 1024:.1f} КБ")
+
+    _, sized = sampled_sizeof(list(active_battles.live.values()))
+    if sized:
+        log_entries = sum(len(b.log) for _, b in sized) / len(sized)
+        log_bytes = sum(deep_sizeof(b.log) for _, b in sized) / len(sized)
+        lines.append("")
+        lines.append(f"Боев: {len(active_battles)} (спящих {len(active_battles.packed)}), "
+                     f"в выборке живых: {len(sized)}")
+        lines.append(f"Средний лог: {log_entries:.0f} записей, {log_bytes / 1024:.1f} КБ")
+        for size, battle in sorted(sized, key=lambda x: x[0], reverse=True)[:3]:
+            lines.append(f"  бой {battle.battle_id}: {size / 1024:.1f} КБ, лог {len(battle.log)} записей")
+
+    info = _attack_distribution.cache_info()
+    lines.append(f"Кэш расчета урона: {info.currsize}/{info.maxsize} записей")
+
+    lines.append("")
+    if not tracemalloc.is_tracing():
+        lines.append("tracemalloc выключен: /memstats trace")
+        return "\n".join(lines)
+
+    current, peak = tracemalloc.get_traced_memory()
+    lines.append(f"tracemalloc: сейчас {current / 1024 / 1024:.1f} МБ, пик {peak / 1024 / 1024:.1f} МБ")
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    lines.append(f"Топ-{top} мест выделения:")
+    for stat in snapshot.statistics("lineno")[:top]:
+        lines.append(f"  {stat.traceback[0]}: {stat.size / 1024:.1f} КБ ({stat.count})")
+
+    if _last_memory_snapshot is not None:
+        lines.append("Рост с прошлого снимка:")
+        for stat in snapshot.compare_to(_last_memory_snapshot, "lineno")[:top]:
+            lines.append(f"  {stat.traceback[0]}: {stat.size_diff / 1024:+.1f} КБ ({stat.count_diff:+})")
+    _last_memory_snapshot = snapshot
+
+    return "\n".join(lines)
+
+
+# ==================== АРЕНА ====================
+# PvP в групповых чатах: много боев на чат, у каждого хода есть срок.
+# Все сроки живут в одной куче DeadlineScheduler и обслуживаются одной задачей.
+ARENA_TURN_SECONDS = float(os.getenv("ARENA_TURN_SECONDS", "60"))
+ARENA_CHALLENGE_SECONDS = float(os.getenv("ARENA_CHALLENGE_SECONDS", "300"))
+ARENA_MAX_TIMEOUTS = 2  # столько пропущенных ходов подряд - техническое поражение
+ARENA_MAX_PER_CHAT = 50
+
+
+class DeadlineScheduler:
+    """Сроки по ключам в одной куче и одна задача, которая их обслуживает.
+
+    schedule - O(log n), cancel - O(1): замененные и отмененные записи не
+    ищутся в куче, а отбрасываются при извлечении; когда их становится больше
+    половины, куча пересобирается. Задача спит до ближайшего срока и будится
+    раньше, только если новый срок раньше всех остальных.
+    """
+
+    def __init__(self):
+        self.heap = []  # (время, номер записи, ключ)
+        self.entries = {}  # ключ -> (время, номер записи, данные)
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.tasks = set()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def schedule(self, key, delay: float, payload=None) -> None:
+        """Срок для key через delay секунд; прежний срок key заменяется"""
+        when = time.monotonic() + delay
+        seq = next(self.counter)
+        self.entries[key] = (when, seq, payload)
+        heapq.heappush(self.heap, (when, seq, key))
+        if self.heap[0][1] == seq:
+            self.wakeup.set()
+        self._compact()
+
+    def cancel(self, key) -> None:
+        self.entries.pop(key, None)
+        self._compact()
+
+    def _is_current(self, item: tuple) -> bool:
+        entry = self.entries.get(item[2])
+        return entry is not None and entry[1] == item[1]
+
+    def _compact(self) -> None:
+        if len(self.heap) > 64 and len(self.heap) > 2 * len(self.entries):
+            self.heap = [(when, seq, key) for key, (when, seq, _) in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def pop_due(self, now: float) -> list[tuple]:
+        """Наступившие сроки: [(ключ, данные)]"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            item = heapq.heappop(self.heap)
+            if self._is_current(item):
+                due.append((item[2], self.entries.pop(item[2])[2]))
+        return due
+
+    async def run(self, callback: Callable) -> None:
+        """Цикл обслуживания: для каждого наступившего срока - задача callback(ключ, данные)"""
+        while True:
+            self.wakeup.clear()
+            for key, payload in self.pop_due(time.monotonic()):
+                metrics["deadlines_fired_total"] += 1
+                task = asyncio.create_task(callback(key, payload))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+            # Устаревшие записи сверху кучи не должны будить задачу
+            while self.heap and not self._is_current(self.heap[0]):
+                heapq.heappop(self.heap)
+            timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+
+
+@dataclass
+class ArenaMatch:
+    battle_id: str
+    chat_id: int
+    message_id: int
+    players: dict  # номер игрока в бою -> tg_id
+    names: dict  # номер игрока в бою -> имя
+    timeouts: collections.Counter = field(default_factory=collections.Counter)  # пропуски подряд
+
+
+class Arena:
+    """Бои арены по ID боя; простаивающие бои упаковываются, как и обычные"""
+
+    def __init__(self):
+        self.battles = BattleTable("arena")
+        self.matches = {}  # battle_id -> ArenaMatch
+        self.challenges = {}  # ID вызова -> (tg_id, chat_id, message_id)
+        self.per_chat = collections.Counter()
+
+    def add(self, match: ArenaMatch, battle: Battle) -> None:
+        self.battles[match.battle_id] = battle
+        self.matches[match.battle_id] = match
+        self.per_chat[match.chat_id] += 1
+
+    def remove(self, match: ArenaMatch) -> None:
+        del self.battles[match.battle_id]
+        del self.matches[match.battle_id]
+        self.per_chat[match.chat_id] -= 1
+        if not self.per_chat[match.chat_id]:
+            del self.per_chat[match.chat_id]
+        deadlines.cancel(("turn", match.battle_id))
+
+    def record_result(self, match: ArenaMatch, winner: int) -> None:
+        """Победа и поражение в профилях обоих игроков одной записью файла"""
+        with players_lock():
+            players = load_players()
+            for number, tg_id in match.players.items():
+                data = players.get(str(tg_id))
+                if data:
+                    counter = "wins" if number == winner else "losses"
+                    data[counter] = data.get(counter, 0) + 1
+            save_players(players)
+
+
+deadlines = DeadlineScheduler()
+arena = Arena()
+
+
 # -------------------- TELEGRAM BOT --------------------
 
+def battle_keyboard(battle: Battle, character: Character, prefix: str = "battle_action_") -> InlineKeyboardMarkup:
+    """Кнопки действий в бою; в данные кнопки входят ID боя и номер хода"""
+    suffix = f":{battle.battle_id}:{battle.current_turn}"
+    keyboard = [
+        [InlineKeyboardButton("Атаковать", callback_data=f"{prefix}{BattleAction.ATTACK}{suffix}")],
+        [InlineKeyboardButton("Встать в блок", callback_data=f"{prefix}{BattleAction.BLOCK}{suffix}")],
+    ]
+
+    if not character.state.skill_used:
+        keyboard.append([InlineKeyboardButton(
+            f"Навык: {character.char_class.offensive_skill_name}",
+            callback_data=f"{prefix}{BattleAction.SKILL_OFFENSIVE}{suffix}"
+        )])
+        keyboard.append([InlineKeyboardButton(
+            f"Навык: {character.char_class.defensive_skill_name}",
+            callback_data=f"{prefix}{BattleAction.SKILL_DEFENSIVE}{suffix}"
+        )])
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+LOG_GZIP_THRESHOLD = 64 * 1024  # лог длиннее этого отправляется сжатым
+
+
+def battle_summary(battle: Battle) -> str:
+    """Короткий итог боя для сообщения вместо полного лога"""
+    winner = battle.get_winner()
+    winner_char = battle.char1 if winner == 1 else battle.char2
+    lines = [
+        f"БОЙ {battle.battle_id} ОКОНЧЕН",
+        f"Ходов: {battle.current_turn - 1}",
+        "",
+    ]
+    for number, c in ((1, battle.char1), (2, battle.char2)):
+        lines.append(f"Игрок {number}: {c.full_name} - HP {max(c.health_points, 0)}/{c.max_health_points}")
+    lines.append("")
+    lines.append(f"=== ПОБЕДИТЕЛЬ: Игрок {winner} ===")
+    lines.append(f"{winner_char.full_name} побеждает!")
+    return "\n".join(lines)
+
+
+def battle_log_document(battle: Battle) -> tuple[bytes, str]:
+    """Полный лог боя как содержимое файла в памяти: (данные, имя файла)"""
+    data = battle.get_full_log().encode("utf-8")
+    filename = f"battle_{battle.battle_id}.txt"
+    if len(data) > LOG_GZIP_THRESHOLD:
+        return gzip.compress(data), filename + ".gz"
+    return data, filename
+
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    await asyncio.to_thread(memory_breakdown)
+    await update.message.reply_text(format_metrics() or "Метрик пока нет")
+
+
+async def memstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/memstats [trace|stop] - память по подсистемам и места выделения (только для админов)"""
+    global _last_memory_snapshot
+
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    command = context.args[0] if context.args else ""
+    if command == "trace" and not tracemalloc.is_tracing():
+        tracemalloc.start(int(os.getenv("TRACEMALLOC_FRAMES", "1")))
+    elif command == "stop" and tracemalloc.is_tracing():
+        tracemalloc.stop()
+        _last_memory_snapshot = None
+
+    report = await asyncio.to_thread(memory_report)
+    await update.message.reply_text(report[:4096])
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = [
         [
@@ -740,12 +2936,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(welcome_text, reply_markup=reply_markup)
 
 
+async def reject_throttled(query) -> bool:
+    """Дребезг и слишком частые нажатия отсекаются до загрузки игроков и отрисовки"""
+    verdict = callback_throttle.check(query.from_user.id, query.data)
+    if verdict:
+        metrics[f"callbacks_{verdict}_total"] += 1
+        await query.answer("Слишком часто, подожди немного" if verdict == "throttled" else None)
+    return verdict is not None
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer()
-
     tg_id = query.from_user.id
 
+    if await reject_throttled(query):
+        return
+
+    # Повторные и устаревшие нажатия отсекаются до любой работы с боем. Ход
+    # применяется сразу после проверки, до первого await: иначе второе нажатие
+    # на тот же ход прошло бы проверку, пока первое ждет ответа Telegram
+    if query.data.startswith("battle_action_"):
+        battle, action, rejection = check_battle_callback(query, tg_id)
+        if rejection:
+            await query.answer(rejection)
+            return
+        player_log = battle.execute_action(action)
+
+    await query.answer()
+
     # ========== СОЗДАНИЕ ПЕРСОНАЖА ==========
     if query.data == "create_menu":
         players = load_players()
@@ -830,7 +3048,6 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         username = query.from_user.username
         name = query.from_user.first_name or "Игрок"
 
-        players = load_players()
         profile = PlayerProfile(
             tg_id=tg_id,
             username=username,
@@ -838,8 +3055,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             race=race,
             char_class=char_class
         )
-        set_profile(players, profile)
-        save_players(players)
+        await asyncio.to_thread(store_profile, profile)
 
         del user_creation_state[tg_id]
 
@@ -876,7 +3092,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         c = make_character_from_profile(profile)
         winrate = (profile.wins / (profile.wins + profile.losses) * 100) if (profile.wins + profile.losses) > 0 else 0
 
+        log_button = "Лог боя: файлом" if profile.log_delivery == "document" else "Лог боя: только итог"
         keyboard = [
+            [InlineKeyboardButton(log_button, callback_data="toggle_log_delivery")],
             [InlineKeyboardButton("Удалить персонажа", callback_data="delete_confirm")],
             [InlineKeyboardButton("В главное меню", callback_data="back_main")]
         ]
@@ -895,6 +3113,18 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         await query.edit_message_text(text, reply_markup=reply_markup)
 
+    elif query.data == "toggle_log_delivery":
+        profile = await asyncio.to_thread(cycle_log_delivery, tg_id)
+
+        if not profile:
+            text = "Сначала создай персонажа!"
+        elif profile.log_delivery == "document":
+            text = "После боя будет приходить итог и полный лог файлом."
+        else:
+            text = "После боя будет приходить только итог."
+        keyboard = [[InlineKeyboardButton("Мой профиль", callback_data="me")]]
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
     # ========== ТЕСТОВЫЙ БОЙ ==========
     elif query.data == "fight_menu":
         players = load_players()
@@ -909,89 +3139,75 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return
 
-        # Создаем бой с самим собой
+        # Новый бой заменяет незаконченный
+        old_battle = active_battles.get(tg_id)
+        if old_battle is not None:
+            battle_owners.pop(old_battle.battle_id, None)
+            spectators.publish(old_battle.battle_id, "Бой прерван игроком.", final=True)
+
+        # Бой против компьютерного противника с тем же персонажем
         c1 = make_character_from_profile(profile)
         c2 = make_character_from_profile(profile)
 
         battle = Battle(c1, c2)
         active_battles[tg_id] = battle
+        battle_owners[battle.battle_id] = tg_id
 
-        keyboard = [
-            [InlineKeyboardButton("Атаковать", callback_data=f"battle_action_{BattleAction.ATTACK}")],
-            [InlineKeyboardButton("Встать в блок", callback_data=f"battle_action_{BattleAction.BLOCK}")],
-        ]
-
-        if not battle.get_current_character().state.skill_used:
-            keyboard.append([InlineKeyboardButton(
-                f"Навык: {battle.get_current_character().char_class.offensive_skill_name}",
-                callback_data=f"battle_action_{BattleAction.SKILL_OFFENSIVE}"
-            )])
-            keyboard.append([InlineKeyboardButton(
-                f"Навык: {battle.get_current_character().char_class.defensive_skill_name}",
-                callback_data=f"battle_action_{BattleAction.SKILL_DEFENSIVE}"
-            )])
+        # ИИ ходит первым, если так выпал жребий
+        ai_logs = await play_ai_turns(battle)
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = battle_keyboard(battle, battle.char1)
 
-        text = battle.get_battle_status()
+        text = "\n".join(ai_logs)
+        text += "\n" + battle.get_battle_status()
+        text += f"\nID боя для зрителей: {battle.battle_id} (/watch {battle.battle_id})"
         text += f"\n\nСейчас ходит: Игрок {battle.current_player}"
         text += f"\nВыбери действие:"
 
         await query.edit_message_text(text, reply_markup=reply_markup)
 
     elif query.data.startswith("battle_action_"):
-        if tg_id not in active_battles:
-            await query.edit_message_text("Бой не найден! Начни новый бой.")
-            return
-
-        battle = active_battles[tg_id]
-        action = query.data.replace("battle_action_", "")
-
-        # Выполняем действие
-        action_log = battle.execute_action(action)
+        # Ход игрока уже сделан сразу после check_battle_callback, теперь ответные ходы ИИ
+        logs = [player_log]
+        logs.extend(await play_ai_turns(battle))
+        action_log = "\n".join(logs)
 
         # Проверяем победу
         winner = battle.get_winner()
         if winner:
             del active_battles[tg_id]
+            del battle_owners[battle.battle_id]
+
+            winner_char = battle.char1 if winner == 1 else battle.char2
+            spectators.publish(
+                battle.battle_id,
+                f"Бой {battle.battle_id}\n{action_log}\n=== ПОБЕДИТЕЛЬ: Игрок {winner} ===\n"
+                f"{winner_char.full_name} побеждает!",
+                final=True,
+            )
 
             keyboard = [[InlineKeyboardButton("В главное меню", callback_data="back_main")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
 
-            full_log = battle.get_full_log()
-
-            # Отправляем лог частями
-            chunk_size = 3500
-            for i in range(0, len(full_log), chunk_size):
-                if i == 0:
-                    await query.edit_message_text(full_log[i:i + chunk_size])
-                else:
-                    await query.message.reply_text(full_log[i:i + chunk_size])
+            # Итог одним сообщением и, по выбору игрока, полный лог одним документом
+            profile = get_profile(load_players(), tg_id)
+            mode = profile.log_delivery if profile else "document"
+            await query.edit_message_text(battle_summary(battle), reply_markup=reply_markup)
 
-            await query.message.reply_text("Выбери действие:", reply_markup=reply_markup)
+            if mode == "document":
+                data, filename = battle_log_document(battle)
+                await query.message.reply_document(data, filename=filename)
+            metrics[f'battle_logs_delivered_total{{mode="{mode}"}}'] += 1
             return
 
         # Продолжаем бой
-        keyboard = [
-            [InlineKeyboardButton("Атаковать", callback_data=f"battle_action_{BattleAction.ATTACK}")],
-            [InlineKeyboardButton("Встать в блок", callback_data=f"battle_action_{BattleAction.BLOCK}")],
-        ]
-
-        current_char = battle.get_current_character()
-        if not current_char.state.skill_used:
-            keyboard.append([InlineKeyboardButton(
-                f"Навык: {current_char.char_class.offensive_skill_name}",
-                callback_data=f"battle_action_{BattleAction.SKILL_OFFENSIVE}"
-            )])
-            keyboard.append([InlineKeyboardButton(
-                f"Навык: {current_char.char_class.defensive_skill_name}",
-                callback_data=f"battle_action_{BattleAction.SKILL_DEFENSIVE}"
-            )])
+        reply_markup = battle_keyboard(battle, battle.char1)
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        status = battle.get_battle_status()
+        spectators.publish(battle.battle_id, f"Бой {battle.battle_id}\n{action_log}\n{status}")
 
         text = action_log
-        text += "\n" + battle.get_battle_status()
+        text += "\n" + status
         text += f"\n\nСейчас ходит: Игрок {battle.current_player}"
         text += f"\nВыбери действие:"
 
@@ -1075,11 +3291,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text(text, reply_markup=reply_markup)
 
     elif query.data == "delete_yes":
-        players = load_players()
-
-        if str(tg_id) in players:
-            del players[str(tg_id)]
-            save_players(players)
+        await asyncio.to_thread(delete_profile, tg_id)
 
         keyboard = [[InlineKeyboardButton("Создать нового персонажа", callback_data="create_menu")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1115,19 +3327,800 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text(text, reply_markup=reply_markup)
 
     elif query.data == "pvp_menu":
-        await query.edit_message_text("PvP режим в разработке! Пока доступен только тестовый бой с самим собой.")
+        await query.edit_message_text(
+            "PvP проходит на арене в групповых чатах: добавь бота в группу и напиши /arena.\n"
+            f"На ход дается {ARENA_TURN_SECONDS:.0f} с, после {ARENA_MAX_TIMEOUTS} пропусков подряд "
+            "засчитывается поражение.")
+
+
+
+# ========== ЗРИТЕЛИ ==========
+async def watch_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/watch <ID боя> - следить за чужим боем"""
+    if not context.args:
+        await update.message.reply_text("Использование: /watch <ID боя>")
+        return
+
+    battle_id = context.args[0]
+    owner = battle_owners.get(battle_id)
+    if owner is None:
+        await update.message.reply_text("Бой не найден или уже закончился.")
+        return
+
+    if not spectators.watch(context.bot, battle_id, update.effective_chat.id):
+        await update.message.reply_text("У этого боя слишком много зрителей, попробуй позже.")
+        return
+
+    battle = active_battles[owner]
+    await update.message.reply_text(
+        f"Ты следишь за боем {battle_id}. /unwatch {battle_id} - перестать\n\n{battle.get_battle_status()}")
+
+
+async def unwatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if context.args:
+        spectators.unwatch(context.args[0], update.effective_chat.id)
+    await update.message.reply_text("Ты больше не следишь за боем.")
+
+
+# ========== ТУРНИР ==========
+current_tournament = None
+TOURNAMENT_NOTIFY_CONCURRENCY = 10
+TOURNAMENT_STATUS_INTERVAL = 2.0  # секунд между правками сообщения с прогрессом
+
+
+async def tournament_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/tournament [single|roundrobin] [random|greedy|expectimax] (только для админов)"""
+    global current_tournament
+
+    # Турнир пишет победы и поражения во все профили и занимает пул процессов
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    if current_tournament is not None:
+        await update.message.reply_text("Турнир уже идет, дождись результатов!")
+        return
+
+    args = context.args or []
+    fmt = args[0] if args else "single"
+    policy = args[1] if len(args) > 1 else "greedy"
+    if fmt not in Tournament.formats or policy not in AUTO_POLICIES:
+        await update.message.reply_text(
+            "Использование: /tournament [single|roundrobin] [random|greedy|expectimax]")
+        return
+
+    participants = list(load_players().values())
+    if len(participants) < 2:
+        await update.message.reply_text("Для турнира нужно хотя бы 2 игрока!")
+        return
+
+    current_tournament = Tournament(participants, fmt, policy)
+    status = await update.message.reply_text(
+        f"ТУРНИР НАЧАЛСЯ!\n\nУчастников: {len(participants)}\nФормат: {fmt}, политика: {policy}")
+    # Не application.create_task: app.stop() ждал бы конца турнира без ограничения по времени.
+    # Задачу прерывает begin_shutdown
+    context.bot_data["tournament_task"] = asyncio.create_task(run_tournament(context.bot, current_tournament, status))
+
+
+async def run_tournament(bot, tournament: Tournament, status) -> None:
+    """Фоновая задача турнира: прогресс в сообщении, итоги участникам"""
+    global current_tournament
+    notify_limit = asyncio.Semaphore(TOURNAMENT_NOTIFY_CONCURRENCY)
+    notifications = set()
+
+    async def notify(tg_id: int, text: str) -> None:
+        async with notify_limit:
+            with contextlib.suppress(Exception):  # Игрок мог не открывать чат с ботом
+                await bot.send_message(tg_id, text)
+
+    last_edit = 0.0
+
+    async def on_round(round_no: int, out: list[int]) -> None:
+        nonlocal last_edit
+        # В круговом турнире раундов столько же, сколько участников: правки сообщения реже раундов
+        now = time.monotonic()
+        if now - last_edit >= TOURNAMENT_STATUS_INTERVAL:
+            last_edit = now
+            with contextlib.suppress(Exception):
+                await status.edit_text(
+                    f"ТУРНИР\n\nРаунд {round_no}/{tournament.rounds_total} завершен\n"
+                    f"Сыграно матчей: {tournament.matches_played}"
+                )
+        if tournament.fmt == "single":
+            # Рассылка не задерживает следующий раунд
+            for tg_id in out:
+                task = asyncio.create_task(notify(
+                    tg_id, f"Турнир: ты выбыл в раунде {round_no}. Побед: {tournament.wins[tg_id]}"))
+                notifications.add(task)
+                task.add_done_callback(notifications.discard)
 
+    try:
+        try:
+            standings = await tournament.run(get_tournament_executor(), on_round)
+        except asyncio.CancelledError:
+            with contextlib.suppress(Exception):
+                await status.edit_text("ТУРНИР ПРЕРВАН: бот перезапускается, результаты не засчитаны.")
+            raise
+        except Exception:
+            with contextlib.suppress(Exception):
+                await status.edit_text("ТУРНИР ПРЕРВАН: ошибка при проведении матчей.")
+            raise
+        await asyncio.to_thread(tournament.save_results)
+
+        champion = tournament.participants[standings[0]]
+        top = "\n".join(
+            f"{place}. {tournament.participants[tg_id]['name']} "
+            f"({tournament.wins[tg_id]}-{tournament.losses[tg_id]})"
+            for place, tg_id in enumerate(standings[:10], 1)
+        )
+        with contextlib.suppress(Exception):
+            await status.edit_text(f"ТУРНИР ЗАВЕРШЕН!\n\nПобедитель: {champion['name']}\n\n{top}")
+
+        # Участникам, которым еще не сообщили о результате
+        finalists = standings if tournament.fmt == "roundrobin" else standings[:1]
+        await asyncio.gather(*notifications, *(
+            notify(tg_id, f"Турнир завершен! Твое место: {place} из {len(standings)}")
+            for place, tg_id in enumerate(finalists, 1)
+        ))
+    finally:
+        current_tournament = None
+
+
+# ========== АРЕНА ==========
+async def arena_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/arena - открытый вызов на бой в групповом чате"""
+    chat = update.effective_chat
+    if chat.type not in ("group", "supergroup"):
+        await update.message.reply_text("Арена работает в групповых чатах: добавь бота в группу и напиши /arena")
+        return
+
+    profile = get_profile(load_players(), update.effective_user.id)
+    if not profile:
+        await update.message.reply_text("Сначала создай персонажа в личном чате с ботом!")
+        return
+    if arena.per_chat[chat.id] >= ARENA_MAX_PER_CHAT:
+        await update.message.reply_text("На арене этого чата слишком много боев, подожди окончания.")
+        return
+
+    c = make_character_from_profile(profile)
+    challenge_id = secrets.token_hex(4)
+    keyboard = [[InlineKeyboardButton("Принять вызов", callback_data=f"arena_join:{challenge_id}")]]
+    message = await update.message.reply_text(
+        f"АРЕНА\n\n{profile.name} ({c.full_name}, ур.{profile.level}) ищет соперника!\n"
+        f"Вызов действует {ARENA_CHALLENGE_SECONDS / 60:.0f} мин.",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
+    arena.challenges[challenge_id] = (profile.tg_id, chat.id, message.message_id)
+    deadlines.schedule(("challenge", challenge_id), ARENA_CHALLENGE_SECONDS)
 
-def main() -> None:
-    token = os.getenv("BOT_TOKEN") or "8571129347:AAFMWWPwsRBBQBWjy-mT25DHTY8XdA2SngY"
-    app = Application.builder().token(token).build()
+
+async def arena_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    tg_id = query.from_user.id
+
+    if await reject_throttled(query):
+        return
+    if not recent_callbacks.add(query.id):
+        metrics["battle_callbacks_duplicate_total"] += 1
+        await query.answer("Нажатие уже обработано")
+        return
+
+    if query.data.startswith("arena_join:"):
+        await arena_join(context.bot, query, query.data.partition(":")[2])
+        return
+
+    # arena_action_<действие>:<id боя>:<номер хода>
+    action, _, rest = query.data.replace("arena_action_", "").partition(":")
+    battle_id, _, turn = rest.partition(":")
+    match = arena.matches.get(battle_id)
+    if match is None:
+        await query.answer("Бой не найден или уже закончился.")
+        return
+
+    battle = arena.battles[battle_id]
+    if tg_id not in match.players.values():
+        await query.answer("Это не твой бой")
+        return
+    if turn != str(battle.current_turn):
+        metrics["battle_callbacks_stale_total"] += 1
+        await query.answer("Кнопка устарела")
+        return
+    if match.players[battle.current_player] != tg_id:
+        await query.answer("Сейчас ход соперника")
+        return
+
+    # Ход применяется до первого await: иначе между проверками и ходом может
+    # сработать срок хода, и нажатие уйдет в ход соперника
+    match.timeouts[battle.current_player] = 0
+    action_log = battle.execute_action(action)
+    await query.answer()
+    await arena_advance(context.bot, match, battle, action_log)
+
+
+async def arena_join(bot, query, challenge_id: str) -> None:
+    challenge = arena.challenges.get(challenge_id)
+    if challenge is None:
+        await query.answer("Вызов уже принят или истек")
+        return
+
+    challenger_id, chat_id, message_id = challenge
+    if query.from_user.id == challenger_id:
+        await query.answer("Нельзя принять свой вызов")
+        return
+
+    players = load_players()
+    first, second = get_profile(players, challenger_id), get_profile(players, query.from_user.id)
+    if second is None:
+        await query.answer("Сначала создай персонажа в личном чате с ботом!", show_alert=True)
+        return
+
+    del arena.challenges[challenge_id]
+    deadlines.cancel(("challenge", challenge_id))
+    await query.answer()
+    if first is None:
+        await query.edit_message_text("Вызов отменен: персонаж удален.")
+        return
+
+    battle = Battle(make_character_from_profile(first), make_character_from_profile(second))
+    match = ArenaMatch(battle.battle_id, chat_id, message_id,
+                       players={1: first.tg_id, 2: second.tg_id}, names={1: first.name, 2: second.name})
+    arena.add(match, battle)
+    metrics["arena_battles_started_total"] += 1
+    await arena_advance(bot, match, battle, f"{first.name} VS {second.name}")
+
+
+async def arena_advance(bot, match: ArenaMatch, battle: Battle, action_log: str) -> None:
+    """Сообщение боя после хода; новый срок хода или итог боя"""
+    winner = battle.get_winner()
+    if winner is None:
+        deadlines.schedule(("turn", battle.battle_id), ARENA_TURN_SECONDS, battle.current_turn)
+        player = battle.current_player
+        text = (
+            f"{action_log}\n{battle.get_battle_status()}\n\n"
+            f"Ходит: {match.names[player]} (Игрок {player}), на ход {ARENA_TURN_SECONDS:.0f} с"
+        )
+        reply_markup = battle_keyboard(battle, battle.get_current_character(), prefix="arena_action_")
+    else:
+        arena.remove(match)
+        await asyncio.to_thread(arena.record_result, match, winner)
+        text = f"{action_log}\n{battle_summary(battle)}\n\nПобедитель: {match.names[winner]}"
+        reply_markup = None
+
+    with contextlib.suppress(Exception):  # Сообщение могли удалить из чата
+        await bot.edit_message_text(
+            text[-4096:], chat_id=match.chat_id, message_id=match.message_id, reply_markup=reply_markup)
+
+
+async def on_deadline(bot, key: tuple, payload) -> None:
+    """Истек срок вызова или хода на арене"""
+    kind, ident = key
+    if kind == "challenge":
+        challenge = arena.challenges.pop(ident, None)
+        if challenge:
+            _, chat_id, message_id = challenge
+            with contextlib.suppress(Exception):
+                await bot.edit_message_text("Вызов истек: соперник не нашелся.", chat_id=chat_id, message_id=message_id)
+        return
+
+    match = arena.matches.get(ident)
+    if match is None:
+        return
+    battle = arena.battles[ident]
+    if battle.current_turn != payload:
+        return  # ход уже сделан
+
+    player = battle.current_player
+    match.timeouts[player] += 1
+    metrics["arena_turn_timeouts_total"] += 1
+
+    if match.timeouts[player] < ARENA_MAX_TIMEOUTS:
+        note = f"Время вышло: {match.names[player]} встает в блок"
+        await arena_advance(bot, match, battle, f"{note}\n{battle.execute_action(BattleAction.BLOCK)}")
+        return
+
+    # Техническое поражение
+    winner = 2 if player == 1 else 1
+    arena.remove(match)
+    await asyncio.to_thread(arena.record_result, match, winner)
+    metrics["arena_forfeits_total"] += 1
+    with contextlib.suppress(Exception):
+        await bot.edit_message_text(
+            f"БОЙ {battle.battle_id} ОКОНЧЕН\n\n{match.names[player]}: пропущено ходов подряд - {ARENA_MAX_TIMEOUTS}.\n"
+            f"Техническая победа: {match.names[winner]}",
+            chat_id=match.chat_id, message_id=match.message_id,
+        )
+
+
+async def arena_notify_restart(bot, saved: bool) -> None:
+    """Сообщение о перезапуске в чаты с боями арены; открытые вызовы отменяются"""
+    text = ("Бот перезапускается. Бои арены сохранены и продолжатся после запуска, время на ход начнется заново."
+            if saved else "Бот перезапускается. Бои арены прерваны, результаты не засчитаны.")
+    sends = [bot.send_message(chat_id, text) for chat_id in list(arena.per_chat)]
+    sends += [
+        bot.edit_message_text("Вызов отменен: бот перезапускается.", chat_id=chat_id, message_id=message_id)
+        for _, chat_id, message_id in arena.challenges.values()
+    ]
+    arena.challenges.clear()
+    await asyncio.gather(*sends, return_exceptions=True)  # Бота могли удалить из чата
+
+
+# ==================== ОСТАНОВКА И ЗДОРОВЬЕ ====================
+SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE", "8"))  # секунд на слив после SIGTERM
+HEALTH_HOST = os.getenv("HEALTH_HOST", "0.0.0.0")
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "0"))  # 0 - без HTTP-проверок
+LOOP_LAG_UNHEALTHY = 5.0  # /healthz: цикл событий завис, процесс пора перезапускать
+LOOP_LAG_NOT_READY = 0.5  # /readyz: процесс перегружен, новый трафик лучше не слать
+UPDATE_QUEUE_NOT_READY = 1000
+
+
+def _character_to_dict(c: Character) -> dict:
+    hp, state = c.snapshot()
+    return {
+        "race": type(c.race).__name__.lower(),
+        "class": type(c.char_class).__name__.lower(),
+        "level": c.level,
+        "hp": hp,
+        "state": state,
+    }
+
+
+def _character_from_dict(data: dict) -> Character:
+    c = Character(get_race(data["race"]), get_class(data["class"]), data["level"])
+    c.restore((data["hp"], data["state"]))
+    return c
+
+
+def battle_to_dict(battle: Battle) -> dict:
+    return {
+        "battle_id": battle.battle_id,
+        "current_player": battle.current_player,
+        "current_turn": battle.current_turn,
+        "log": battle.log,
+        "chars": [_character_to_dict(battle.char1), _character_to_dict(battle.char2)],
+        "rng": battle.rng.getstate(),
+    }
+
+
+def battle_from_dict(data: dict) -> Battle:
+    battle = Battle.__new__(Battle)
+    battle.battle_id = data["battle_id"]
+    battle.char1, battle.char2 = (_character_from_dict(c) for c in data["chars"])
+    battle.current_player = data["current_player"]
+    battle.current_turn = data["current_turn"]
+    battle.log = data["log"]
+    version, internal, gauss = data["rng"]
+    battle.rng = random.Random()
+    battle.rng.setstate((version, tuple(internal), gauss))
+    return battle
+
+
+def _arena_match_to_dict(match: ArenaMatch) -> dict:
+    return {
+        "chat_id": match.chat_id,
+        "message_id": match.message_id,
+        "players": match.players,
+        "names": match.names,
+        "timeouts": match.timeouts,
+        "battle": battle_to_dict(arena.battles.peek(match.battle_id)),
+    }
+
+
+def _arena_match_from_dict(data: dict) -> tuple[ArenaMatch, Battle]:
+    battle = battle_from_dict(data["battle"])
+    match = ArenaMatch(
+        battle.battle_id, data["chat_id"], data["message_id"],
+        players={int(k): v for k, v in data["players"].items()},
+        names={int(k): v for k, v in data["names"].items()},
+        timeouts=collections.Counter({int(k): v for k, v in data["timeouts"].items()}),
+    )
+    return match, battle
+
+
+def save_battles(path: str) -> int:
+    """Снимок active_battles и боев арены в файл. Возвращает число боев"""
+    data = {str(tg_id): battle_to_dict(active_battles.peek(tg_id)) for tg_id in active_battles}
+    if arena.matches:
+        # Ключ не совпадает ни с одним tg_id; старые снимки его просто не содержат
+        data["arena"] = [_arena_match_to_dict(match) for match in arena.matches.values()]
+    with _atomic_open(path) as f:
+        json.dump(data, f, ensure_ascii=False)
+    return len(active_battles) + len(arena.matches)
+
+
+def restore_battles(path: str) -> int:
+    """Загрузка снимка боев после перезапуска. Снимок одноразовый и удаляется"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except json.JSONDecodeError:
+        print(f"Поврежденный снимок боев {path} пропущен")
+        return 0
+
+    arena_data = data.pop("arena", [])
+    for tg_id, battle_data in data.items():
+        battle = battle_from_dict(battle_data)
+        active_battles[int(tg_id)] = battle
+        battle_owners[battle.battle_id] = int(tg_id)
+    for match_data in arena_data:
+        match, battle = _arena_match_from_dict(match_data)
+        arena.add(match, battle)
+        deadlines.schedule(("turn", battle.battle_id), ARENA_TURN_SECONDS, battle.current_turn)
+    os.remove(path)
+    return len(data) + len(arena_data)
+
+
+def check_storage() -> str | None:
+    """None, если хранилище игроков доступно для записи, иначе описание проблемы"""
+    path = PLAYERS_BIN_FILE if PLAYERS_FORMAT == "binary" else PLAYERS_FILE
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.access(directory, os.W_OK):
+        return f"нет записи в каталог {directory}"
+    if os.path.exists(path) and not os.access(path, os.R_OK | os.W_OK):
+        return f"нет доступа к {path}"
+    return None
+
+
+class HealthMonitor:
+    """Задержка цикла событий, глубина очередей и хранилище для /healthz и /readyz"""
+
+    def __init__(self, interval: float = 0.25):
+        self.interval = interval
+        self.loop_lag = 0.0
+        self.ready = False
+        self.app = None
+        self._lag_task = None
+        self._server = None
+
+    async def start(self, app: Application, port: int) -> None:
+        self.app = app
+        self._lag_task = asyncio.create_task(self._measure_lag())
+        if port:
+            self._server = await asyncio.start_server(self._handle, HEALTH_HOST, port)
+        self.ready = True
+
+    async def stop(self) -> None:
+        self.ready = False
+        if self._lag_task:
+            self._lag_task.cancel()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _measure_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.loop_lag = max(0.0, loop.time() - started - self.interval)
+            metrics["event_loop_lag_seconds"] = round(self.loop_lag, 4)
+
+    def queue_depths(self) -> dict[str, int]:
+        depths = {"spectator_frames": spectators.queue_depth()}
+        if self.app is not None:
+            depths["updates"] = self.app.update_queue.qsize()
+            for i, queue in enumerate(self.app.bot_data.get("shard_queues", ())):
+                with contextlib.suppress(NotImplementedError):  # macOS
+                    depths[f"shard_{i}"] = queue.qsize()
+        return depths
+
+    def report(self, readiness: bool) -> tuple[bool, dict]:
+        """(здоров ли, тело ответа). Живость - только зависание цикла событий"""
+        depths = self.queue_depths()
+        storage_error = check_storage()
+
+        problems = []
+        if self.loop_lag > LOOP_LAG_UNHEALTHY:
+            problems.append("цикл событий не отвечает")
+        if readiness:
+            if not self.ready:
+                problems.append("запуск или остановка")
+            if self.loop_lag > LOOP_LAG_NOT_READY:
+                problems.append("большая задержка цикла событий")
+            if max(depths.values()) > UPDATE_QUEUE_NOT_READY:
+                problems.append("переполнены очереди")
+            if storage_error:
+                problems.append(storage_error)
+
+        return not problems, {
+            "status": "fail" if problems else "ok",
+            "problems": problems,
+            "loop_lag_ms": round(self.loop_lag * 1000, 1),
+            "queues": depths,
+            "storage": storage_error or "ok",
+            "active_battles": len(active_battles),
+            "arena_battles": len(arena.battles),
+            "deadlines": len(deadlines),
+        }
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Минимальный HTTP/1.1: GET /healthz и GET /readyz, ответ JSON"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+                pass  # заголовки не нужны
+
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].partition("?")[0] if len(parts) > 1 else ""
+            if path in ("/healthz", "/readyz"):
+                ok, body = self.report(readiness=path == "/readyz")
+                status = "200 OK" if ok else "503 Service Unavailable"
+            else:
+                status, body = "404 Not Found", {"status": "not found"}
+
+            payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1") + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+health = HealthMonitor()
+
+
+def begin_shutdown(app: Application) -> None:
+    """Начало остановки: /readyz сразу отвечает 503, идущий турнир прерывается.
+
+    Вызывается до app.stop(): тот еще обрабатывает очередь апдейтов, и в это
+    время новый трафик на процесс слать не нужно.
+    """
+    health.ready = False
+    task = app.bot_data.get("tournament_task")
+    if task is not None and not task.done():
+        task.cancel()
+
+
+def _on_stop_signal(app: Application) -> None:
+    begin_shutdown(app)
+    raise SystemExit  # как обработчик сигналов run_polling
+
+
+async def on_startup(app: Application) -> None:
+    """Восстановление боев из снимка и запуск проверок здоровья"""
+    battles_file = app.bot_data.get("battles_file", BATTLES_FILE)
+    if battles_file:
+        restored = restore_battles(battles_file)
+        if restored:
+            print(f"Восстановлено боев: {restored}")
+    await health.start(app, app.bot_data.get("health_port", HEALTH_PORT))
+    if app.updater is not None:
+        # Замена обработчиков run_polling, чтобы остановка начиналась с begin_shutdown.
+        # Воркеры шардов сигналы игнорируют: их останавливает фронт
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            with contextlib.suppress(NotImplementedError):  # Windows
+                loop.add_signal_handler(sig, _on_stop_signal, app)
+    app.bot_data["background_tasks"] = [
+        asyncio.create_task(active_battles.hibernate_loop()),
+        asyncio.create_task(arena.battles.hibernate_loop()),
+        asyncio.create_task(deadlines.run(functools.partial(on_deadline, app.bot))),
+    ]
+
+
+async def on_stop(app: Application) -> None:
+    """Слив при остановке (SIGTERM/SIGINT) не дольше SHUTDOWN_DEADLINE секунд.
+
+    Апдейты к этому моменту уже обработаны: профили пишутся синхронно под
+    players_lock, так что остаются кадры зрителям, сообщения в чаты арены и
+    снимок незаконченных боев.
+    """
+    begin_shutdown(app)
+    for task in app.bot_data.pop("background_tasks", ()):
+        task.cancel()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_DEADLINE
+    battles_file = app.bot_data.get("battles_file", BATTLES_FILE)
+
+    try:
+        # Секунда в запасе на запись снимка боев
+        await asyncio.wait_for(
+            asyncio.gather(
+                spectators.drain("Бот перезапускается, трансляция прервана."),
+                arena_notify_restart(app.bot, saved=bool(battles_file)),
+                *(task for task in [app.bot_data.get("tournament_task")] if task is not None),
+                return_exceptions=True,
+            ),
+            max(0.0, deadline - loop.time() - 1),
+        )
+    except asyncio.TimeoutError:
+        print(f"Не все сообщения отправлены: осталось задач зрителей {len(spectators.tasks)}")
+
+    if battles_file and (active_battles or arena.matches):
+        print(f"Сохранено боев: {await asyncio.to_thread(save_battles, battles_file)}")
+
+    await asyncio.to_thread(shutdown_tournament_executor)
+    await health.stop()
+
+
+# ==================== ШАРДИРОВАНИЕ ====================
+BOT_API_URL = os.getenv("BOT_API_URL")  # свой сервер Bot API вместо api.telegram.org
+
+
+def application_builder(token: str):
+    builder = Application.builder().token(token)
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL.rstrip('/')}/bot")
+    return builder
+
+
+def shard_for_update(update: Update, shards: int) -> int:
+    """Номер воркера для апдейта: все апдейты пользователя идут в один процесс.
+
+    Апдейты группового чата идут по ID чата: бои арены живут в одном воркере.
+    """
+    chat = update.effective_chat
+    if chat and chat.type in ("group", "supergroup"):
+        return chat.id % shards
+    user = update.effective_user
+    return user.id % shards if user else 0
+
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фронт: пересылка апдейта воркеру-владельцу пользователя"""
+    queues = context.bot_data["shard_queues"]
+    queues[shard_for_update(update, len(queues))].put(update.to_dict())
+
+
+def run_shard_worker(token: str, queue, shard: int) -> None:
+    """Точка входа процесса-воркера"""
+    # Сигналы получает вся группа процессов; воркеры останавливает фронт через очередь,
+    # чтобы каждый успел сохранить свои бои
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_shard_worker(token, queue, shard))
+
+
+async def _shard_worker(token: str, queue, shard: int) -> None:
+    app = build_application(token, with_updater=False)
+    # Свой снимок боев у каждого воркера; HTTP-проверки отвечает фронт
+    app.bot_data["battles_file"] = f"active_battles.shard-{shard}.json"
+    app.bot_data["health_port"] = 0
+    loop = asyncio.get_running_loop()
+
+    async with app:
+        await on_startup(app)
+        await app.start()
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        begin_shutdown(app)
+        await app.stop()
+        await on_stop(app)
+
+
+def run_sharded(token: str, shards: int) -> None:
+    """Фронт-процесс с polling и N воркеров, владеющих боями своих пользователей"""
+    queues = [multiprocessing.Queue() for _ in range(shards)]
+    # Не daemon: демоническому процессу нельзя запускать свой пул процессов для /tournament.
+    # Зато завершать воркеры приходится явно, см. finally ниже
+    workers = [
+        multiprocessing.Process(target=run_shard_worker, args=(token, queue, i), name=f"shard-{i}")
+        for i, queue in enumerate(queues)
+    ]
+    for worker in workers:
+        worker.start()
+
+    front = application_builder(token).post_init(on_startup).post_stop(on_stop).build()
+    front.bot_data["shard_queues"] = queues
+    front.bot_data["battles_file"] = None  # бои живут в воркерах
+    front.add_handler(TypeHandler(Update, route_update))
+
+    print(f"Бот запущен! Воркеров: {shards}")
+    try:
+        front.run_polling()
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join(timeout=SHUTDOWN_DEADLINE + 2)
+            if worker.is_alive():
+                print(f"Воркер {worker.name} не остановился вовремя и будет завершен")
+                worker.terminate()
+                worker.join()
+
+
+def build_application(token: str | None = None, with_updater: bool = True, bot=None) -> Application:
+    """Приложение со всеми обработчиками; bot - готовый бот (например, с заглушкой API)"""
+    builder = Application.builder()
+    if bot is not None:
+        builder = builder.bot(bot).updater(None)
+    else:
+        builder = application_builder(token).post_init(on_startup).post_stop(on_stop)
+        if not with_updater:
+            builder = builder.updater(None)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("metrics", metrics_command))
+    app.add_handler(CommandHandler("memstats", memstats_command))
+    app.add_handler(CommandHandler("tournament", tournament_command))
+    app.add_handler(CommandHandler("watch", watch_command))
+    app.add_handler(CommandHandler("unwatch", unwatch_command))
+    app.add_handler(CommandHandler("arena", arena_command))
+    app.add_handler(CallbackQueryHandler(arena_button_handler, pattern="^arena_"))
     app.add_handler(CallbackQueryHandler(button_handler))
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="RPG Battle Bot")
+    parser.add_argument(
+        "--shards", type=int, default=int(os.getenv("BOT_SHARDS", "1")),
+        help="количество процессов-воркеров (по tg_id)",
+    )
+    commands = parser.add_subparsers(dest="command")
+    convert = commands.add_parser("convert-players", help="конвертация players.json <-> players.bin")
+    convert.add_argument("direction", choices=("to-binary", "to-json"))
+
+    tune = commands.add_parser("tune-balance", help="подбор констант рас и классов к винрейту 50%%")
+    tune.add_argument("--games", type=int, default=100, help="боев на пару при полной оценке")
+    tune.add_argument("--screen-games", type=int, default=25, help="боев на пару при отсеве")
+    tune.add_argument("--level", type=int, default=3)
+    tune.add_argument("--policy", choices=tuple(AUTO_POLICIES), default="greedy")
+    tune.add_argument("--tolerance", type=float, default=0.05, help="допустимое отклонение винрейта от 50%%")
+    tune.add_argument("--max-iters", type=int, default=20)
+    tune.add_argument("--workers", type=int, default=None)
+    tune.add_argument("--seed", type=int, default=0)
+    tune.add_argument("--output", help="JSON с константами до и после")
+
+    export = commands.add_parser("export-players", help="выгрузка профилей в NDJSON/CSV")
+    export.add_argument("path", nargs="?", default="-", help="файл или - для stdout")
+    load = commands.add_parser("import-players", help="загрузка профилей из NDJSON/CSV с заменой по tg_id")
+    load.add_argument("path", help="файл или - для stdin")
+    load.add_argument("--batch-size", type=int, default=50_000)
+    for sub in (export, load):
+        sub.add_argument("--format", choices=EXPORT_FORMATS, help="по умолчанию - по расширению файла")
+        sub.add_argument("--race", action="append", choices=RACE_CODES, default=[])
+        sub.add_argument("--class", dest="classes", action="append", choices=CLASS_CODES, default=[])
+        sub.add_argument("--min-level", type=int, default=1)
+        sub.add_argument("--max-level", type=int, default=Character.max_level)
+    args = parser.parse_args()
+
+    if args.command == "convert-players":
+        print(f"Сконвертировано записей: {convert_players(args.direction)}")
+        return
+
+    if args.command == "tune-balance":
+        tune_balance(args.games, args.screen_games, args.level, args.policy, args.tolerance,
+                     args.max_iters, args.workers, args.seed, args.output)
+        return
+
+    if args.command in ("export-players", "import-players"):
+        where = ProfileFilter(tuple(args.race), tuple(args.classes), args.min_level, args.max_level)
+        if args.command == "export-players":
+            exported = export_players(args.path, args.format, where)
+            print(f"Выгружено записей: {exported}", file=sys.stderr)
+        else:
+            imported, rejected = import_players(args.path, args.format, where, args.batch_size)
+            print(f"Загружено записей: {imported}, отклонено: {rejected}", file=sys.stderr)
+        return
+
+    token = os.getenv("BOT_TOKEN") or "8571129347:AAFMWWPwsRBBQBWjy-mT25DHTY8XdA2SngY"
+
+    # Трассировка с самого старта, чтобы /memstats видел и ранние выделения
+    if os.getenv("TRACEMALLOC_FRAMES"):
+        tracemalloc.start(int(os.getenv("TRACEMALLOC_FRAMES")))
+
+    upgraded = migrate_players()
+    if upgraded:
+        print(f"Обновлено записей игроков: {upgraded} (схема v{PLAYER_SCHEMA_VERSION})")
+
+    if args.shards > 1:
+        run_sharded(token, args.shards)
+        return
+
+    app = build_application(token)
 
     print("Бот запущен!")
     app.run_polling()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,96 @@
+import itertools
+import random
+
+import pytest
+
+import rpgbot
+from rpgbot import Battle, BattleAction, Character
+
+RACES = ("elf", "human", "troll")
+CLASSES = ("warrior", "paladin", "mage", "archer", "warlock")
+ACTIONS = (BattleAction.ATTACK, BattleAction.BLOCK, BattleAction.SKILL_OFFENSIVE, BattleAction.SKILL_DEFENSIVE)
+
+# Каждый класс против каждого, расы по кругу - все расы встречаются у обоих игроков
+MATCHUPS = [
+    (RACES[i % 3], class1, RACES[(i + 1) % 3], class2)
+    for i, (class1, class2) in enumerate(itertools.product(CLASSES, repeat=2))
+]
+
+
+def make_battle(race1: str, class1: str, race2: str, class2: str, seed: int) -> Battle:
+    return Battle(
+        Character(rpgbot.get_race(race1), rpgbot.get_class(class1), 2),
+        Character(rpgbot.get_race(race2), rpgbot.get_class(class2), 2),
+        seed=seed,
+    )
+
+
+def full_state(battle: Battle) -> tuple:
+    """Все изменяемое в бою, включая то, чего нет в snapshot(): лог целиком и списки хуков"""
+    return (
+        battle.battle_id,
+        battle.current_player,
+        battle.current_turn,
+        tuple(battle.log),
+        battle.rng.getstate(),
+        *((c.health_points, c.state.as_tuple(), c.effects, c.hooks) for c in (battle.char1, battle.char2)),
+    )
+
+
+def play(battle: Battle, actions: random.Random, turns: int) -> None:
+    for _ in range(turns):
+        if battle.get_winner() is not None:
+            return
+        battle.execute_action(actions.choice(ACTIONS))
+
+
+@pytest.mark.parametrize("matchup", MATCHUPS, ids="-".join)
+def test_restore_round_trips_exactly(matchup):
+    for seed in range(5):
+        battle = make_battle(*matchup, seed)
+        play(battle, random.Random(seed), 4)
+
+        snap = battle.snapshot()
+        before = full_state(battle)
+        play(battle, random.Random(100 + seed), 30)
+        after = full_state(battle)
+
+        battle.restore(snap)
+        assert full_state(battle) == before
+
+        # После отката бой продолжается точно так же: генератор тоже откатан
+        play(battle, random.Random(100 + seed), 30)
+        assert full_state(battle) == after
+
+
+@pytest.mark.parametrize("matchup", MATCHUPS, ids="-".join)
+def test_clone_act_restore(matchup):
+    for seed in range(5):
+        battle = make_battle(*matchup, seed)
+        play(battle, random.Random(seed), 3)
+        original = full_state(battle)
+
+        twin = battle.clone()
+        assert full_state(twin) == original
+
+        snap = twin.snapshot()
+        play(twin, random.Random(200 + seed), 30)
+        assert full_state(battle) == original  # копия не делит состояние с оригиналом
+
+        twin.restore(snap)
+        assert full_state(twin) == original
+
+        play(battle, random.Random(200 + seed), 30)
+        play(twin, random.Random(200 + seed), 30)
+        assert full_state(twin) == full_state(battle)
+
+
+def test_snapshot_without_rng_keeps_generator():
+    battle = make_battle("elf", "mage", "troll", "warlock", seed=1)
+    snap = battle.snapshot(with_rng=False)
+    battle.execute_action(BattleAction.ATTACK)
+    rng_state = battle.rng.getstate()
+
+    battle.restore(snap)
+    assert battle.rng.getstate() == rng_state
+    assert battle.current_turn == snap[1]
@@ -0,0 +1,155 @@
+import json
+import multiprocessing
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+from telegram import Update
+
+import rpgbot
+
+pytestmark = pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="воркеры наследуют настройки теста через fork")
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "RPG Battle Bot", "username": "rpg_battle_bot"}
+API_LATENCY = 0.01
+
+
+def private_update(update_id: int, tg_id: int, data: str | None = None) -> dict:
+    user = {"id": tg_id, "is_bot": False, "first_name": f"Игрок {tg_id}"}
+    message = {"message_id": update_id, "date": 0, "chat": {"id": tg_id, "type": "private"}, "from": user}
+    if data is None:
+        return {"update_id": update_id, "message": {**message, "text": "/start",
+                                                     "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+    return {"update_id": update_id,
+            "callback_query": {"id": str(update_id), "from": user, "chat_instance": "1", "data": data,
+                               "message": {**message, "from": BOT_USER, "text": "меню"}}}
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """Bot API на localhost: отвечает с задержкой и записывает (время, метод, параметры)"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _FakeBotAPIHandler)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def texts(self, method: str) -> list[tuple[int, str]]:
+        with self.lock:
+            return [(int(p["chat_id"]), p.get("text", "")) for _, m, p in self.calls if m == method]
+
+
+class _FakeBotAPIHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        params = {k: v[0] for k, v in parse_qs(body).items()}
+        with self.server.lock:
+            self.server.calls.append((time.monotonic(), method, params))
+        time.sleep(API_LATENCY)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            chat = {"id": int(params["chat_id"]), "type": "private"}
+            result = {"message_id": int(params.get("message_id", 1)), "date": 0, "chat": chat,
+                      "from": BOT_USER, "text": params.get("text", "")}
+        else:
+            result = True
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def bot_api(monkeypatch, tmp_path):
+    server = FakeBotAPI()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rpgbot, "BOT_API_URL", server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def create_characters(bot_api: FakeBotAPI, shards: int, users: list[int]) -> float:
+    """Создание персонажей через N воркеров; время от первого до последнего ответа API"""
+    queues = [multiprocessing.Queue() for _ in range(shards)]
+    workers = [multiprocessing.Process(target=rpgbot.run_shard_worker, args=("1:test", queue, i))
+               for i, queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+
+    # Шаг race_ запоминается в памяти воркера: класс без липкой маршрутизации не выбрать
+    update_ids = iter(range(1, 10**6))
+    for tg_id in users:
+        for data in (None, "create_menu", "race_elf", "class_mage"):
+            update = Update.de_json(private_update(next(update_ids), tg_id, data), None)
+            queues[rpgbot.shard_for_update(update, shards)].put(update.to_dict())
+
+    started = time.monotonic()
+    try:
+        while time.monotonic() - started < 60:
+            created = [text for _, text in bot_api.texts("editMessageText") if text.startswith("ПЕРСОНАЖ СОЗДАН")]
+            if len(created) == len(users):
+                break
+            time.sleep(0.05)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join(timeout=15)
+            if worker.is_alive():
+                worker.terminate()
+
+    with bot_api.lock:
+        handled = [t for t, method, _ in bot_api.calls if method != "getMe"]
+    return max(handled) - min(handled)
+
+
+def test_shard_for_update_is_sticky():
+    for shards in (2, 3, 8):
+        for tg_id in range(1000, 1100):
+            shard = rpgbot.shard_for_update(Update.de_json(private_update(1, tg_id), None), shards)
+            assert 0 <= shard < shards
+            for data in ("create_menu", f"battle_action_attack:abc:{tg_id % 7}", "me"):
+                update = Update.de_json(private_update(2, tg_id, data), None)
+                assert rpgbot.shard_for_update(update, shards) == shard
+
+
+def test_group_chat_updates_follow_chat():
+    update = private_update(1, 42, "arena_join:abcd")
+    update["callback_query"]["message"]["chat"] = {"id": -1005, "type": "supergroup"}
+    assert rpgbot.shard_for_update(Update.de_json(update, None), 4) == -1005 % 4
+
+
+def test_workers_keep_user_state_and_scale(bot_api):
+    users = list(range(5000, 5032))
+    single = create_characters(bot_api, 1, users)
+
+    created = bot_api.texts("editMessageText")
+    assert sum(text.startswith("ПЕРСОНАЖ СОЗДАН") for _, text in created) == len(users)
+    assert not [text for _, text in created if text.startswith("Ошибка")]
+    assert set(json.load(open("players.json", encoding="utf-8"))) >= {str(u) for u in users}
+
+    with bot_api.lock:
+        bot_api.calls.clear()
+    sharded = create_characters(bot_api, 4, users)
+    assert sum(text.startswith("ПЕРСОНАЖ СОЗДАН") for _, text in bot_api.texts("editMessageText")) == len(users)
+
+    # Воркер обрабатывает апдейты по одному, так что 4 воркера заметно быстрее одного
+    assert sharded < single / 1.5